@@ -0,0 +1,393 @@
+"""
+Load test / benchmark for server.py
+
+Starts the FTP server in this process on an ephemeral port, with a temporary root directory,
+and drives it with a fleet of simulated clients (threads) through these scenarios:
+- login    - login storm (connect, USER, PASS, QUIT)
+- list     - LIST of a directory with many entries
+- small    - many small STOR + RETR transfers
+- large    - a few large STOR + RETR transfers
+- idle     - memory (RSS) per idle logged-in session, at each of --idle-sessions counts
+             (two file descriptors per session, raise `ulimit -n` accordingly; not on Windows)
+With --storage memory files are kept in RAM, to measure transfers without disk I/O.
+
+Results (ops/s, MB/s, p50/p99 latency) are printed as JSON, so runs on different commits can be compared.
+
+Usage: python bench.py [--clients 8] [--scenarios login,list,small,large] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bcrypt
+
+try:
+    import resource
+except ImportError:  # not available on Windows, no idle scenario there
+    resource = None
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench"
+
+
+class BenchClient:
+    """Minimal FTP client, only what the scenarios need and without any output"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.control_socket = socket.create_connection((host, port))
+        self.control_file = self.control_socket.makefile("rb")
+        self.expect(220)
+
+    def read_response(self):
+        line = self.control_file.readline().decode("utf-8")
+        if not line:
+            raise ConnectionError("Control connection closed.")
+        code = int(line[:3])
+        if line[3:4] == "-":  # multi-line response, ends with "<code> "
+            while not line.startswith(f"{code} "):
+                line = self.control_file.readline().decode("utf-8")
+        return code, line
+
+    def command(self, command):
+        self.control_socket.sendall(f"{command}\r\n".encode("utf-8"))
+        return self.read_response()
+
+    def expect(self, *codes, command=None):
+        code, line = self.command(command) if command else self.read_response()
+        if code not in codes:
+            raise Exception(f"Unexpected response: {line.strip()}")
+        return line
+
+    def login(self, username, password):
+        self.expect(331, command=f"USER {username}")
+        self.expect(230, command=f"PASS {password}")
+        self.expect(200, command="TYPE I")
+
+    def open_data_connection(self):
+        response = self.expect(227, command="PASV")
+        numbers = response[response.find("(") + 1 : response.find(")")].split(",")
+        port = (int(numbers[4]) << 8) + int(numbers[5])
+        return socket.create_connection((self.host, port))
+
+    def retrieve(self, command):
+        """Run a command sending data to the client (RETR, LIST), return number of bytes received"""
+        data_socket = self.open_data_connection()
+        self.expect(150, command=command)
+        received = 0
+        buffer = bytearray(256 * 1024)
+        with data_socket:
+            while True:
+                n = data_socket.recv_into(buffer)
+                if not n:
+                    break
+                received += n
+        self.expect(226)
+        return received
+
+    def store(self, path, payload):
+        data_socket = self.open_data_connection()
+        self.expect(150, command=f"STOR {path}")
+        with data_socket:
+            data_socket.sendall(payload)
+        self.expect(226)
+        return len(payload)
+
+    def quit(self):
+        try:
+            self.command("QUIT")
+        finally:
+            self.control_file.close()
+            self.control_socket.close()
+
+
+class Scenario:
+    """
+    Runs `operations` calls of `operation(client, index)` spread over `clients` threads.
+    Each thread keeps its own session, unless the operation creates its own connections (session=False).
+    `setup(client)` is called once per session, after login.
+    """
+
+    def __init__(self, name, operation, operations, session=True, setup=None):
+        self.name = name
+        self.operation = operation
+        self.operations = operations
+        self.session = session
+        self.setup = setup
+        self.latencies = []
+        self.transferred = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.next_index = 0
+
+    def take_index(self):
+        with self.lock:
+            if self.next_index >= self.operations:
+                return None
+            self.next_index += 1
+            return self.next_index - 1
+
+    def worker(self, host, port):
+        client = None
+        try:
+            if self.session:
+                client = BenchClient(host, port)
+                client.login(BENCH_USER, BENCH_PASSWORD)
+                if self.setup:
+                    self.setup(client)
+            while (index := self.take_index()) is not None:
+                started = time.perf_counter()
+                try:
+                    transferred = self.operation(client, index)
+                except Exception:
+                    with self.lock:
+                        self.errors += 1
+                    continue
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.latencies.append(elapsed)
+                    self.transferred += transferred or 0
+        finally:
+            if client:
+                client.quit()
+
+    def run(self, host, port, clients):
+        threads = [
+            threading.Thread(target=self.worker, args=(host, port))
+            for _ in range(clients)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - started)
+
+    def report(self, seconds):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[round(p / 100 * (len(latencies) - 1))] * 1000, 3)
+
+        return {
+            "ops": len(latencies),
+            "errors": self.errors,
+            "seconds": round(seconds, 3),
+            "ops_per_s": round(len(latencies) / seconds, 1),
+            "mb_per_s": round(self.transferred / seconds / 1024**2, 2),
+            "latency_ms": {
+                "p50": percentile(50),
+                "p99": percentile(99),
+                "max": percentile(100),
+            },
+        }
+
+
+def rss_bytes():
+    """Resident set size of this process"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak, not current; good enough as sessions are only added
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def idle_connection(host, port):
+    """Logged-in anonymous control connection, a bare socket to keep client-side memory low"""
+    sock = socket.create_connection((host, port))
+    for command, code in ((None, b"220"), ("USER anonymous", b"331"), ("PASS", b"230")):
+        if command:
+            sock.sendall(f"{command}\r\n".encode("utf-8"))
+        response = sock.recv(1024)
+        if not response.startswith(code):
+            sock.close()
+            raise Exception(f"Unexpected response: {response.strip()!r}")
+    return sock
+
+
+def measure_idle(host, port, counts):
+    """RSS of the process with growing numbers of idle sessions (server and client side)"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:  # two descriptors per session
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    connections = []
+    baseline = rss_bytes()
+    results = {"baseline_rss_mb": round(baseline / 1024**2, 1)}
+    try:
+        for count in sorted(counts):
+            try:
+                while len(connections) < count:
+                    connections.append(idle_connection(host, port))
+            except Exception as e:
+                results[str(count)] = {"error": str(e), "sessions": len(connections)}
+                break
+            time.sleep(1)  # let all session threads reach their idle recv()
+            rss = rss_bytes()
+            results[str(count)] = {
+                "rss_mb": round(rss / 1024**2, 1),
+                "kb_per_session": round((rss - baseline) / count / 1024, 1),
+                "threads": threading.active_count(),
+            }
+    finally:
+        for connection in connections:
+            connection.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def start_server(root, args):
+    """Start the server in this process, on an ephemeral port, serving the temporary root"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from server import FTPServer, ServerConfig
+
+    config = ServerConfig(
+        root_dir=os.path.join(root, "ftp"),
+        host="127.0.0.1",
+        port=0,
+        passive_port_range=map(int, args.passive_ports.split(",")),
+        users_file=os.path.join(root, "users.json"),
+        usage_index_file=os.path.join(root, "usage.json"),
+        storage=args.storage,
+        allow_anonymous=True,
+        thread_stack_size=args.thread_stack_size,
+    )
+    ftp_server = FTPServer(config)
+
+    home = ftp_server.storage.resolve(os.path.join(root, "ftp", BENCH_USER))
+    ftp_server.storage.mkdir(home)
+    password = bcrypt.hashpw(
+        BENCH_PASSWORD.encode(), bcrypt.gensalt(args.bcrypt_rounds)
+    ).decode()
+    ftp_server.users.insert(
+        {"username": BENCH_USER, "password": password, "home": str(home)}
+    )
+
+    port = ftp_server.bind()
+    threading.Thread(target=ftp_server.start, daemon=True).start()
+    return port, ftp_server.storage, home
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for the FTP server.")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--scenarios", default="login,list,small,large")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--list-entries", type=int, default=5000)
+    parser.add_argument("--lists", type=int, default=100)
+    parser.add_argument("--small-files", type=int, default=500)
+    parser.add_argument("--small-size", type=int, default=4 * 1024)
+    parser.add_argument("--large-files", type=int, default=2)
+    parser.add_argument("--large-size", type=int, default=64 * 1024**2)
+    parser.add_argument("--passive-ports", default="40000,59999")
+    parser.add_argument("--idle-sessions", default="1000,5000,10000")
+    parser.add_argument(
+        "--thread-stack-size", type=int, default=0, help="bytes, 0 - platform default"
+    )
+    parser.add_argument("--storage", choices=["local", "memory"], default="local")
+    parser.add_argument("--output", help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="ftpbench-")
+    port, storage, home = start_server(root, args)
+
+    def login(client, index):
+        client = BenchClient("127.0.0.1", port)
+        client.login(BENCH_USER, BENCH_PASSWORD)
+        client.quit()
+
+    list_dir = home / "big"
+    storage.mkdir(list_dir)
+    if "list" in args.scenarios:
+        for i in range(args.list_entries):
+            storage.open(list_dir / f"file{i:07}.txt", "wb").close()
+
+    def list_big(client, index):
+        return client.retrieve("LIST")
+
+    small_payload = os.urandom(args.small_size)
+    large_payload = os.urandom(args.large_size) if "large" in args.scenarios else b""
+
+    def small(client, index):
+        path = f"/small{index}.bin"
+        return client.store(path, small_payload) + client.retrieve(f"RETR {path}")
+
+    def large(client, index):
+        path = f"/large{index}.bin"
+        return client.store(path, large_payload) + client.retrieve(f"RETR {path}")
+
+    scenarios = {
+        "login": Scenario("login", login, args.logins, session=False),
+        "list": Scenario(
+            "list",
+            list_big,
+            args.lists,
+            setup=lambda client: client.expect(250, command="CWD /big"),
+        ),
+        "small": Scenario("small", small, args.small_files),
+        "large": Scenario("large", large, args.large_files),
+    }
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "scenarios": {},
+    }
+    try:
+        for name in args.scenarios.split(","):
+            if name.strip() == "idle":
+                if resource is None:
+                    print("Skipping idle, needs the resource module.", file=sys.stderr)
+                    continue
+                print("Running idle...", file=sys.stderr)
+                results["scenarios"]["idle"] = measure_idle(
+                    "127.0.0.1", port, map(int, args.idle_sessions.split(","))
+                )
+                continue
+            scenario = scenarios[name.strip()]
+            print(f"Running {scenario.name}...", file=sys.stderr)
+            results["scenarios"][scenario.name] = scenario.run(
+                "127.0.0.1", port, args.clients
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
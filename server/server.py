@@ -1,64 +1,1581 @@
+import atexit
+import concurrent.futures
+import errno
+import fnmatch
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import secrets
+import select
+import shutil
+import signal
 import socket
 import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from tinydb import TinyDB, Query
 import bcrypt
 import configparser
+import io
+import json
+import mmap
+import stat
+import struct
 import sys
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 """
 Do konfiguracji używane są dwa pliki 
 - <nazwa>.conf (nazwa do konfiguracji niżej, domyślnie ftpserver.conf)
 - users.json (opcjonalne, zostanie utworzony automatycznie jeśli nie podany)
 """
 
-# Configurable Settings via Config File
-CONFIG_FILE = "ftpserver.conf"
-config = configparser.ConfigParser()
-try:
-    config.read(CONFIG_FILE)
-    FTP_IP = config["SERVER"].get("Host", "0.0.0.0")
-    FTP_PORT = int(config["SERVER"].get("Port", "21"))
-    PASSIVE_PORT_RANGE = tuple(
-        map(int, config["SERVER"].get("PassivePortRange", "50000,50100").split(","))
+
+class ServerConfig:
+    """
+    Server settings. Create it directly (embedding, tests, benchmarks) or read it from a config file with from_file().
+    Nothing is read or created until a server is built from it.
+    """
+
+    def __init__(
+        self,
+        root_dir="./ftp",
+        host="0.0.0.0",
+        port=21,
+        passive_port_range=(50000, 50100),
+        session_timeout=300,
+        login_timeout=30,
+        data_timeout=60,
+        allow_anonymous=False,
+        users_file="users.json",
+        path_cache_size=4096,
+        log_level="INFO",
+        log_file="",
+        trace_commands=False,
+        transfer_log="",
+        storage="local",
+        file_cache_size=0,
+        file_cache_mmap_threshold=1024 * 1024,
+        sync_policy="none",
+        group_commit_interval=10,
+        usage_index_file="",
+        scan_workers=8,
+        tree_max_depth=32,
+        tree_max_entries=1000000,
+        filename_index=False,
+        find_max_results=10000,
+        thread_stack_size=0,
+        admin_users=(),
+        profile_sample_rate=0.0,
+        profile_interval=5,
+        profile_file="profile.folded",
+    ):
+        self.root_dir = Path(root_dir).resolve()
+        self.host = host
+        self.port = port  # 0 binds to an ephemeral port
+        self.passive_port_range = tuple(passive_port_range)
+        self.session_timeout = session_timeout
+        self.login_timeout = login_timeout
+        self.data_timeout = data_timeout
+        self.allow_anonymous = allow_anonymous
+        self.users_file = users_file
+        self.path_cache_size = path_cache_size
+        self.log_level = log_level.upper()
+        self.log_file = log_file
+        self.trace_commands = trace_commands
+        self.transfer_log = transfer_log
+        if storage not in STORAGES:
+            raise ValueError(f"Unknown storage: {storage}")
+        self.storage = storage  # name from STORAGES
+        self.file_cache_size = file_cache_size  # bytes, 0 disables the RETR cache
+        self.file_cache_mmap_threshold = file_cache_mmap_threshold
+        if sync_policy not in ("none", "file", "group"):
+            raise ValueError(f"Unknown sync policy: {sync_policy}")
+        self.sync_policy = (
+            sync_policy  # fsync of uploads: none, file (each upload) or group (batched)
+        )
+        self.group_commit_interval = group_commit_interval  # ms
+        self.usage_index_file = (
+            usage_index_file  # "" - rebuild usage index on every start
+        )
+        self.scan_workers = scan_workers
+        self.tree_max_depth = tree_max_depth  # limits of SITE TREE
+        self.tree_max_entries = tree_max_entries
+        self.filename_index = filename_index  # index of names in homes for SITE FIND
+        self.find_max_results = find_max_results
+        self.thread_stack_size = thread_stack_size  # bytes, 0 - platform default
+        self.admin_users = tuple(admin_users)  # may use SITE PROFILE
+        if not 0 <= profile_sample_rate <= 1:
+            raise ValueError(f"Profile sample rate must be 0-1: {profile_sample_rate}")
+        self.profile_sample_rate = profile_sample_rate  # fraction of commands, 0 - off
+        self.profile_interval = profile_interval  # ms between stack samples
+        self.profile_file = (
+            profile_file  # collapsed stacks, written on SITE PROFILE or SIGUSR1
+        )
+
+    @classmethod
+    def from_file(cls, config_file="ftpserver.conf"):
+        """
+        Read settings from the [SERVER] section of a config file.
+
+        Raises:
+            FileNotFoundError: config file doesn't exist
+            KeyError: missing section or required option
+            ValueError: invalid value
+        """
+        config = configparser.ConfigParser()
+        if not config.read(config_file, encoding="utf-8"):
+            raise FileNotFoundError(config_file)
+        section = config["SERVER"]
+        return cls(
+            root_dir=section["RootDirectory"],
+            host=section.get("Host", "0.0.0.0"),
+            port=int(section.get("Port", "21")),
+            passive_port_range=map(
+                int, section.get("PassivePortRange", "50000,50100").split(",")
+            ),
+            session_timeout=int(section.get("SessionTimeout", "300")),
+            login_timeout=int(section.get("LoginTimeout", "30")),
+            data_timeout=int(section.get("DataTimeout", "60")),
+            allow_anonymous=section.getboolean("AllowAnonymous", False),
+            users_file=section.get("UsersFile", "users.json"),
+            path_cache_size=int(section.get("PathCacheSize", "4096")),
+            log_level=section.get("LogLevel", "INFO"),
+            log_file=section.get("LogFile", ""),
+            trace_commands=section.getboolean("TraceCommands", False),
+            transfer_log=section.get("TransferLog", ""),
+            storage=section.get("Storage", "local").lower(),
+            file_cache_size=int(section.get("FileCacheSize", "0")),
+            file_cache_mmap_threshold=int(
+                section.get("FileCacheMmapThreshold", str(1024 * 1024))
+            ),
+            sync_policy=section.get("SyncPolicy", "none").lower(),
+            group_commit_interval=int(section.get("GroupCommitInterval", "10")),
+            usage_index_file=section.get("UsageIndexFile", ""),
+            scan_workers=int(section.get("ScanWorkers", "8")),
+            tree_max_depth=int(section.get("TreeMaxDepth", "32")),
+            tree_max_entries=int(section.get("TreeMaxEntries", "1000000")),
+            filename_index=section.getboolean("FilenameIndex", False),
+            find_max_results=int(section.get("FindMaxResults", "10000")),
+            thread_stack_size=int(section.get("ThreadStackSize", "0")),
+            admin_users=[
+                name.strip()
+                for name in section.get("AdminUsers", "").split(",")
+                if name.strip()
+            ],
+            profile_sample_rate=float(section.get("ProfileSampleRate", "0")),
+            profile_interval=int(section.get("ProfileInterval", "5")),
+            profile_file=section.get("ProfileFile", "profile.folded"),
+        )
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread doing the actual log output.
+
+    Session threads only put records on a queue (see QueueHandler below), this thread formats
+    them and writes them in batches, flushing once per batch instead of once per line.
+    Records of the ftpserver.xfer logger go to the transfer log, everything else to the main log.
+    """
+
+    BATCH_SIZE = 256
+
+    def __init__(self, log_stream, transfer_stream=None):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.log_stream = log_stream
+        self.transfer_stream = transfer_stream
+        self.formatter = logging.Formatter(
+            "%(asctime)s %(levelname)s [%(session)s] %(message)s"
+        )
+        # xferlog format (wu-ftpd), date is the first field
+        self.transfer_formatter = logging.Formatter(
+            "%(asctime)s %(message)s", datefmt="%a %b %d %H:%M:%S %Y"
+        )
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]  # block until there is something to write
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:  # stop() was called
+                    self.flush()
+                    return
+                self.write(record)
+            self.flush()
+
+    def write(self, record):
+        try:
+            if record.name == "ftpserver.xfer":
+                if self.transfer_stream:
+                    self.transfer_stream.write(
+                        self.transfer_formatter.format(record) + "\n"
+                    )
+            else:
+                record.__dict__.setdefault("session", "-")
+                self.log_stream.write(self.formatter.format(record) + "\n")
+        except Exception:
+            pass  # never let a broken record kill the writer
+
+    def flush(self):
+        self.log_stream.flush()
+        if self.transfer_stream:
+            self.transfer_stream.flush()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hand the record over to the LogWriter as-is, formatting happens there"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(config):
+    """
+    Route server logs through a LogWriter according to config. Called by main(),
+    embedded servers that don't call it only get warnings and errors on stderr.
+    """
+    log_writer = LogWriter(
+        open(config.log_file, "a", encoding="utf-8") if config.log_file else sys.stdout,
+        (
+            open(config.transfer_log, "a", encoding="utf-8")
+            if config.transfer_log
+            else None
+        ),
     )
-    SESSION_TIMEOUT = int(config["SERVER"].get("SessionTimeout", "300"))
-    LOGIN_TIMEOUT = int(config["SERVER"].get("LoginTimeout", "30"))
-    DATA_TIMEOUT = int(config["SERVER"].get("DataTimeout", "60"))
-    ROOT_DIR = Path(config["SERVER"].get("RootDirectory")).resolve()
-    ALLOW_ANONYMOUS = config["SERVER"].getboolean("AllowAnonymous", False)
-except configparser.NoSectionError as e:
-    print(f"Error: Missing section in configuration file: {e}")
-    sys.exit(1)
-except configparser.NoOptionError as e:
-    print(f"Error: Missing option in configuration file: {e}")
-    sys.exit(1)
-except ValueError as e:
-    print(f"Error: Invalid value in configuration file: {e}")
-    sys.exit(1)
-except FileNotFoundError as e:
-    print(f"Error: Configuration file not found: {e}")
-    sys.exit(1)
-except Exception as e:
-    print(f"Unexpected error: {e}")
-    sys.exit(1)
-
-
-db = TinyDB("users.json")
-
-# Preload Default Users
-if not db.contains(Query().username == "anonymous"):
-    db.insert(
-        {"username": "anonymous", "password": None, "home": str(ROOT_DIR / "anonymous")}
+    handler = QueueHandler(log_writer.queue)
+    for name in ("ftpserver", "ftpserver.xfer"):
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.propagate = False
+    logging.getLogger("ftpserver").setLevel(config.log_level)
+    # per-command trace (every sent/received line) is opt-in
+    logging.getLogger("ftpserver.trace").setLevel(
+        logging.DEBUG if config.trace_commands else logging.CRITICAL + 1
     )
+    logging.getLogger("ftpserver.xfer").setLevel(
+        logging.INFO if config.transfer_log else logging.CRITICAL + 1
+    )
+    log_writer.start()
+    atexit.register(log_writer.stop)
+
+
+class SessionLog(logging.LoggerAdapter):
+    """Adds client address and user name of the session to every record"""
+
+    def process(self, msg, kwargs):
+        session = self.extra
+        kwargs["extra"] = {
+            "session": f"{session.address[0]}:{session.address[1]} {session.user or '-'}"
+        }
+        return msg, kwargs
+
+
+log = logging.getLogger("ftpserver")
+trace_log = logging.getLogger("ftpserver.trace")
+transfer_log = logging.getLogger("ftpserver.xfer")
+
+
+class PathCache:
+    """
+    LRU cache of paths already resolved and validated by FTPSession.sanitize_path, shared by all sessions.
+
+    Key is (home, base directory, path as sent by client). Value is the resolved path and
+    whether the full path (True) or only its parent (False) was seen to exist.
+    Commands changing the tree (MKD, RMD, DELE, RNTO) have to call invalidate().
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size  # 0 disables caching
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if not self.max_size:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, resolved_path, exists):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.entries[key] = (resolved_path, exists)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)  # least recently used
+
+    def invalidate(self, path):
+        """Drop every entry resolving to the path or to anything below it"""
+        parts = path.parts
+        with self.lock:
+            stale = [
+                key
+                for key, (resolved_path, _) in self.entries.items()
+                if resolved_path.parts[: len(parts)] == parts
+            ]
+            for key in stale:
+                del self.entries[key]
+
+
+class FileCache:
+    """
+    Cache of frequently downloaded files for RETR, shared by all sessions.
+
+    Files smaller than mmap_threshold are held in memory as bytes, bigger ones as read-only
+    mmap views (pages shared with the OS page cache). A file is admitted on its second RETR,
+    entries are evicted least recently used first when the total size exceeds max_bytes.
+    An entry is dropped when its size or mtime changed, or by invalidate() (STOR, DELE, RNTO, ...).
+    Memory of an evicted mmap is released when the last transfer using it ends.
+    """
+
+    def __init__(self, storage, max_bytes, mmap_threshold=1024 * 1024):
+        self.storage = storage
+        self.max_bytes = max_bytes  # 0 disables caching
+        self.mmap_threshold = mmap_threshold
+        self.entries = OrderedDict()  # path -> (content, size, mtime)
+        self.seen = OrderedDict()  # paths requested once, candidates for admission
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Return file content (bytes or mmap) or None if the file isn't cached (yet)"""
+        if not self.max_bytes:
+            return None
+        stats = self.storage.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and (entry[1], entry[2]) == (stats.st_size, stats.st_mtime):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            if entry:  # file changed since it was cached
+                self._remove(path)
+            self.misses += 1
+            if path not in self.seen:
+                self.seen[path] = True
+                if len(self.seen) > 4096:
+                    self.seen.popitem(last=False)
+                return None
+            del self.seen[path]
+        if stats.st_size > self.max_bytes:
+            return None
+        content = self._load(path, stats.st_size)
+        if content is None:
+            return None
+        with self.lock:
+            if path not in self.entries:
+                self.entries[path] = (content, stats.st_size, stats.st_mtime)
+                self.total_bytes += stats.st_size
+                while self.total_bytes > self.max_bytes:
+                    self._remove(next(iter(self.entries)))  # least recently used
+        return content
+
+    def _load(self, path, size):
+        with self.storage.open(path, "rb") as f:
+            if size < self.mmap_threshold:
+                return f.read()
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError, io.UnsupportedOperation):
+                return None  # e.g. storage without real files, don't cache
+
+    def _remove(self, path):
+        content, size, _ = self.entries.pop(path)
+        self.total_bytes -= size
+
+    def invalidate(self, path):
+        """Drop cached content of the path and of anything below it"""
+        if not self.max_bytes:
+            return
+        parts = path.parts
+        with self.lock:
+            for cached_path in [
+                cached_path
+                for cached_path in self.entries
+                if cached_path.parts[: len(parts)] == parts
+            ]:
+                self._remove(cached_path)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 3) if requests else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }
+
+
+class UsageIndex:
+    """
+    Disk usage (bytes, number of files) of every user's home, used for quotas.
+
+    Built once at startup by walking all homes in parallel, then kept current by the commands
+    changing files (update()). Saved to index_file on shutdown and loaded on the next start
+    instead of walking again, unless the server didn't shut down cleanly.
+    """
+
+    def __init__(self, storage, index_file="", workers=8):
+        self.storage = storage
+        self.index_file = index_file
+        self.workers = workers
+        self.usage = {}  # username -> {"home": str, "bytes": int, "files": int}
+        self.lock = threading.Lock()
+
+    def load_or_rebuild(self, users):
+        """users is a list of (username, home path)"""
+        if not self.load(users):
+            self.rebuild(users)
+        self.save(clean=False)  # a crash from now on means the index can't be trusted
+
+    def load(self, users):
+        if not self.index_file:
+            return False
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not saved.get("clean"):
+            return False
+        usage = saved.get("users", {})
+        for username, home in users:
+            if usage.get(username, {}).get("home") != str(home):
+                return False  # new user or home changed
+        with self.lock:
+            self.usage = usage
+        return True
+
+    def save(self, clean=True):
+        if not self.index_file:
+            return
+        with self.lock:
+            data = json.dumps({"clean": clean, "users": self.usage})
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(temp_file, self.index_file)
+
+    def rebuild(self, users):
+        """Walk all homes with a pool of threads, one directory per task"""
+        usage = {
+            username: {"home": str(home), "bytes": 0, "files": 0}
+            for username, home in users
+        }
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            pending = {
+                pool.submit(self._scan, username, home) for username, home in users
+            }
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    username, size, files, subdirs = future.result()
+                    usage[username]["bytes"] += size
+                    usage[username]["files"] += files
+                    pending |= {
+                        pool.submit(self._scan, username, subdir) for subdir in subdirs
+                    }
+        with self.lock:
+            self.usage = usage
+        log.info("Usage index rebuilt for %d users.", len(usage))
+
+    def _scan(self, username, path):
+        size, files, subdirs = 0, 0, []
+        try:
+            for name, is_dir, entry_size, _ in self.storage.scandir(path):
+                if is_dir:
+                    subdirs.append(path / name)
+                elif not is_partial_upload(name):
+                    size += entry_size  # unfinished uploads don't count
+                    files += 1
+        except FileNotFoundError:
+            pass  # home not created yet
+        return username, size, files, subdirs
+
+    def get(self, username):
+        """Return (bytes, files) used by the user"""
+        with self.lock:
+            usage = self.usage.get(username)
+            return (usage["bytes"], usage["files"]) if usage else (0, 0)
+
+    def update(self, username, bytes_delta=0, files_delta=0):
+        with self.lock:
+            usage = self.usage.setdefault(
+                username, {"home": "", "bytes": 0, "files": 0}
+            )
+            usage["bytes"] += bytes_delta
+            usage["files"] += files_delta
+
+
+def is_partial_upload(name):
+    """Temporary file of an unfinished STOR"""
+    return name.startswith(".") and name.endswith(".part")
+
+
+class HomeNames:
+    """
+    Filename index of one home. Paths are relative to the home, "/"-separated, "" is the home.
+
+    Besides the entries of every directory, each name maps to the directories it occurs in and each
+    trigram (3 characters) to the names containing it, so a search only has to match the names
+    sharing all trigrams of the pattern's literal parts.
+    """
+
+    def __init__(self):
+        self.children = {"": set()}  # directory -> names of its entries
+        self.dirs_by_name = {}  # name -> directories containing an entry with that name
+        self.trigrams = {}  # trigram -> names containing it
+        self.ready = False  # initial scan finished
+        self.removed = set()  # paths removed while the scan is running
+        self.rescan = []  # directories moved while the scan is running
+        self.lock = threading.Lock()
+
+    def add(self, path, is_dir=False):
+        with self.lock:
+            self.removed.discard(path)
+            self._add(path, is_dir)
+
+    def add_scanned(self, directory, entries):
+        """Add entries (name, is_dir) found in the directory by the scan, unless removed meanwhile"""
+        with self.lock:
+            if directory not in self.children:
+                return
+            for name, is_dir in entries:
+                path = f"{directory}/{name}" if directory else name
+                if path not in self.removed:
+                    self._add(path, is_dir)
+
+    def remove(self, path):
+        with self.lock:
+            if not self.ready:
+                self.removed.add(path)
+            self._remove(path)
+
+    def rename(self, source, target, is_dir=False):
+        with self.lock:
+            is_dir = is_dir or source in self.children
+            below = self._subtree(source) if is_dir else []
+            self._remove(source)
+            self.removed.discard(target)
+            self._add(target, is_dir)
+            for path, path_is_dir in below:
+                self._add(target + path[len(source) :], path_is_dir)
+            if is_dir and not self.ready:
+                self.rescan.append(target)  # may not have been scanned yet
+
+    def find(self, pattern, limit):
+        """Return up to limit paths of entries whose name matches the glob pattern"""
+        literals = re.split(r"\[!?\]?[^\]]*\]|[*?]", pattern)
+        trigrams = {
+            literal[i : i + 3] for literal in literals for i in range(len(literal) - 2)
+        }
+        result = []
+        with self.lock:
+            if trigrams:
+                postings = sorted(
+                    (self.trigrams.get(trigram, ()) for trigram in trigrams), key=len
+                )
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:  # nothing to narrow down with, e.g. "*.c"
+                candidates = self.dirs_by_name
+            for name in candidates:
+                if not fnmatch.fnmatchcase(name, pattern):
+                    continue
+                for directory in self.dirs_by_name[name]:
+                    path = f"{directory}/{name}" if directory else name
+                    result.append(path + "/" if path in self.children else path)
+                    if len(result) >= limit:
+                        return result
+        return result
+
+    def _add(self, path, is_dir):
+        directory, _, name = path.rpartition("/")
+        entries = self.children.setdefault(directory, set())
+        if name not in entries:
+            entries.add(name)
+            directories = self.dirs_by_name.get(name)
+            if directories is None:
+                directories = self.dirs_by_name[name] = set()
+                for i in range(len(name) - 2):
+                    self.trigrams.setdefault(name[i : i + 3], set()).add(name)
+            directories.add(directory)
+        if is_dir:
+            self.children.setdefault(path, set())
+
+    def _remove(self, path):
+        directory, _, name = path.rpartition("/")
+        if name not in self.children.get(directory, ()):
+            return
+        self._unlink(directory, name)
+        below = self._subtree(path)
+        for below_path, is_dir in below:
+            below_directory, _, below_name = below_path.rpartition("/")
+            self._unlink(below_directory, below_name)
+            if not self.ready:
+                self.removed.add(below_path)
+        for below_path, is_dir in below:
+            if is_dir:
+                del self.children[below_path]
+        self.children.pop(path, None)
+
+    def _unlink(self, directory, name):
+        self.children[directory].discard(name)
+        directories = self.dirs_by_name[name]
+        directories.discard(directory)
+        if not directories:
+            del self.dirs_by_name[name]
+            for i in range(len(name) - 2):
+                names = self.trigrams[name[i : i + 3]]
+                names.discard(name)
+                if not names:
+                    del self.trigrams[name[i : i + 3]]
+
+    def _subtree(self, path):
+        """(path, is_dir) of everything below the directory, parents before their entries"""
+        result, stack = [], [path]
+        while stack:
+            directory = stack.pop()
+            for name in self.children.get(directory, ()):
+                below = f"{directory}/{name}"
+                is_dir = below in self.children
+                result.append((below, is_dir))
+                if is_dir:
+                    stack.append(below)
+        return result
+
+
+class NameIndex:
+    """
+    Filename index of the users' homes for SITE FIND, optional (FilenameIndex in the config).
+
+    Homes are scanned in the background, at startup or on the first search in a new home, and
+    kept current by the commands changing files (added(), removed(), renamed()).
+    """
+
+    def __init__(self, storage, enabled=False, workers=8):
+        self.storage = storage
+        self.enabled = enabled
+        self.workers = workers
+        self.homes = {}  # home path -> HomeNames
+        self.lock = threading.Lock()
+        self.pool = None
+        self.stopped = False
+
+    def build(self, homes):
+        """Start scanning the homes in the background"""
+        for home in homes:
+            self.get(home)
+
+    def get(self, home):
+        """Return HomeNames of the home, scanning it first if unknown. None if disabled."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            names = self.homes.get(home)
+            if names is None:
+                names = self.homes[home] = HomeNames()
+                if self.pool is None:
+                    self.pool = concurrent.futures.ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="name-index"
+                    )
+                self.pool.submit(self._scan, home, names)
+        return names
+
+    def close(self):
+        self.stopped = True
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _scan(self, home, names):
+        started = time.perf_counter()
+        stack = [""]
+        while not self.stopped:
+            if not stack:
+                with names.lock:
+                    if not names.rescan:
+                        names.ready = True
+                        names.removed.clear()
+                        break
+                    stack, names.rescan = names.rescan, []
+            directory = stack.pop()
+            try:
+                entries = [
+                    (name, is_dir)
+                    for name, is_dir, _, _ in self.storage.scandir(home / directory)
+                    if is_dir or not is_partial_upload(name)
+                ]
+            except OSError:
+                continue  # removed meanwhile
+            names.add_scanned(directory, entries)
+            stack.extend(
+                f"{directory}/{name}" if directory else name
+                for name, is_dir in entries
+                if is_dir
+            )
+        if names.ready:
+            log.info(
+                "Filename index of %s built in %.1fs.",
+                home,
+                time.perf_counter() - started,
+            )
+
+    def _homes_of(self, path):
+        """(HomeNames, relative path) of every indexed home containing the path"""
+        for parent in path.parents:
+            names = self.homes.get(parent)
+            if names is not None:
+                yield names, path.relative_to(parent).as_posix()
+
+    def added(self, path, is_dir=False):
+        for names, relative in self._homes_of(path):
+            names.add(relative, is_dir)
+
+    def removed(self, path):
+        for names, relative in self._homes_of(path):
+            names.remove(relative)
+
+    def renamed(self, source, target):
+        is_dir = self.storage.is_dir(target)
+        targets = dict(self._homes_of(target))
+        for names, relative in self._homes_of(source):
+            if names in targets:
+                names.rename(relative, targets.pop(names), is_dir)
+            else:  # moved out of this home
+                names.remove(relative)
+        for names, relative in targets.items():  # moved into this home
+            names.add(relative, is_dir)
+
+
+FICLONE = 0x40049409  # ioctl from linux/fs.h, clones file extents (reflink)
+
+
+def copy_file(source, target):
+    """
+    Copy a file on the server without pulling its data through Python buffers.
+
+    A reflink clone is tried first (btrfs, xfs), then os.copy_file_range (in-kernel copy),
+    and shutil.copyfileobj is the fallback for platforms that support neither.
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        if fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass  # filesystem can't share extents
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError:
+                # e.g. cross-device copy on older kernels, start over the portable way
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+class Storage:
+    """
+    Interface for file operations of FTPSession. All paths are absolute Path objects.
+    Errors are reported the way the local filesystem does it, with OSError subclasses
+    (FileNotFoundError, FileExistsError, IsADirectoryError, ...).
+    """
+
+    def resolve(self, path):
+        """Return the absolute, normalized path"""
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def is_dir(self, path):
+        raise NotImplementedError
+
+    def is_file(self, path):
+        raise NotImplementedError
+
+    def stat(self, path):
+        """Return os.stat_result (at least st_mode, st_nlink, st_size, st_mtime)"""
+        raise NotImplementedError
+
+    def listdir(self, path):
+        """Return names of the directory entries"""
+        raise NotImplementedError
+
+    def scandir(self, path):
+        """Iterate over (name, is_dir, size, mtime) of the directory entries, size is 0 for directories"""
+        raise NotImplementedError
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def open(self, path, mode="rb"):
+        """Open a file for reading or writing, mode is one of rb, wb, r, w"""
+        raise NotImplementedError
+
+    def open_upload(self, path, mode="wb", size_hint=None):
+        """
+        Start writing a new version of the file, mode is wb or w. Returns an object with
+        write(data), commit() and abort(). Until commit() readers keep seeing the old content,
+        after abort() nothing is left behind.
+        """
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        """Create the directory and missing parents, existing directory is not an error"""
+        raise NotImplementedError
+
+    def rmdir(self, path):
+        raise NotImplementedError
+
+    def unlink(self, path):
+        raise NotImplementedError
+
+    def rename(self, source, target):
+        raise NotImplementedError
+
+    def copy(self, source, target):
+        raise NotImplementedError
+
+
+def fsync_directory(path):
+    """Make a rename in the directory durable, not possible (and not needed) on Windows"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class LocalUpload:
+    """
+    Upload written to a temporary file next to the target and moved over it with os.replace() on commit.
+    With a size hint (ALLO) the space is allocated up front where the OS supports it.
+    """
+
+    def __init__(self, storage, path, mode, size_hint=None):
+        self.storage = storage
+        self.path = path
+        self.temp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.part")
+        fd = os.open(
+            self.temp_path,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+            0o666,  # same permissions as open() would give
+        )
+        if size_hint and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size_hint)
+            except OSError:
+                pass  # not supported by the filesystem, it's only a hint
+        self.file = os.fdopen(fd, mode)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        try:
+            self.file.truncate()  # drop space allocated beyond the data
+            self.file.flush()
+            self.storage.commit_upload(self)
+        except BaseException:
+            self.abort()
+            raise
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class GroupCommitter(threading.Thread):
+    """
+    Group commit for SyncPolicy = group. Uploads wait in commit() until the next batch, which
+    runs `interval` seconds after the first upload arrives: data of every upload in the batch
+    is fsynced, moved into place, and then each directory is fsynced only once.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="group-commit", daemon=True)
+        self.interval = interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def commit(self, upload):
+        request = {"upload": upload, "done": threading.Event(), "error": None}
+        with self.lock:
+            self.pending.append(request)
+        self.wakeup.set()
+        request["done"].wait()
+        if request["error"]:
+            raise request["error"]
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)  # let more uploads join the batch
+            self.wakeup.clear()
+            with self.lock:
+                batch, self.pending = self.pending, []
+            directories = set()
+            for request in batch:
+                upload = request["upload"]
+                try:
+                    os.fsync(upload.file.fileno())
+                    os.replace(upload.temp_path, upload.path)
+                    directories.add(upload.path.parent)
+                except OSError as e:
+                    request["error"] = e
+            for directory in directories:
+                fsync_directory(directory)
+            for request in batch:
+                request["done"].set()
 
 
-class FTPSession(threading.Thread):
+class LocalStorage(Storage):
+    """Files on the local filesystem (default)"""
+
+    def __init__(self, sync_policy="none", group_commit_interval=0.01):
+        self.sync_policy = sync_policy
+        self.group_committer = None
+        if sync_policy == "group":
+            self.group_committer = GroupCommitter(group_commit_interval)
+            self.group_committer.start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.sync_policy, config.group_commit_interval / 1000)
+
+    def resolve(self, path):
+        return Path(path).resolve()
+
+    def exists(self, path):
+        return path.exists()
+
+    def is_dir(self, path):
+        return path.is_dir()
+
+    def is_file(self, path):
+        return path.is_file()
+
+    def stat(self, path):
+        return path.stat()
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def scandir(self, path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                stats = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(stats.st_mode):
+                    yield entry.name, True, 0, stats.st_mtime
+                else:
+                    yield entry.name, False, stats.st_size, stats.st_mtime
+
+    def open(self, path, mode="rb"):
+        return open(path, mode)
+
+    def open_upload(self, path, mode="wb", size_hint=None):
+        return LocalUpload(self, path, mode, size_hint)
+
+    def commit_upload(self, upload):
+        """Move a finished upload into place, syncing it according to the policy"""
+        if self.sync_policy == "group":
+            self.group_committer.commit(upload)
+            return
+        if self.sync_policy == "file":
+            os.fsync(upload.file.fileno())
+        os.replace(upload.temp_path, upload.path)
+        if self.sync_policy == "file":
+            fsync_directory(upload.path.parent)
+
+    def mkdir(self, path):
+        path.mkdir(parents=True, exist_ok=True)
+
+    def rmdir(self, path):
+        path.rmdir()
+
+    def unlink(self, path):
+        path.unlink()
+
+    def rename(self, source, target):
+        source.rename(target)
+
+    def copy(self, source, target):
+        # copy next to the target and replace it at once, like uploads
+        temp_path = target.with_name(f".{target.name}.{secrets.token_hex(4)}.part")
+        try:
+            copy_file(source, temp_path)
+            os.replace(temp_path, target)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+
+class MemoryStorage(Storage):
+    """
+    Files kept in RAM, lost when the server stops. Useful to benchmark transfers without disk I/O
+    and to serve hot datasets from memory. Paths are normalized without touching the disk.
+    """
+
+    class WriteBuffer(io.BytesIO):
+        """File opened for writing, its content is stored on close"""
+
+        def __init__(self, storage, path):
+            super().__init__()
+            self.storage = storage
+            self.path = path
+
+        def close(self):
+            if not self.closed:
+                self.storage.store(self.path, self.getvalue())
+            super().close()
+
+    class Upload:
+        """New content is collected in a buffer and stored at once on commit"""
+
+        def __init__(self, storage, path, mode):
+            self.storage = storage
+            self.path = path
+            self.buffer = io.BytesIO()
+            self.file = (
+                self.buffer
+                if "b" in mode
+                else io.TextIOWrapper(self.buffer, encoding="utf-8")
+            )
+
+        def write(self, data):
+            self.file.write(data)
+
+        def commit(self):
+            self.file.flush()
+            self.storage.store(self.path, self.buffer.getvalue())
+
+        def abort(self):
+            self.buffer = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}  # path -> [content, mtime]
+        self.dirs = {}  # path -> [set of entry names, mtime]
+
+    def resolve(self, path):
+        return Path(os.path.abspath(path))
+
+    def _dir(self, path):
+        """Return directory entry, filesystem roots always exist"""
+        entry = self.dirs.get(path)
+        if entry is None and path == path.parent:
+            entry = self.dirs[path] = [set(), time.time()]
+        return entry
+
+    def exists(self, path):
+        with self.lock:
+            return path in self.files or self._dir(path) is not None
+
+    def is_dir(self, path):
+        with self.lock:
+            return self._dir(path) is not None
+
+    def is_file(self, path):
+        with self.lock:
+            return path in self.files
+
+    def stat(self, path):
+        with self.lock:
+            if path in self.files:
+                content, mtime = self.files[path]
+                mode, nlink, size = stat.S_IFREG | 0o644, 1, len(content)
+            elif self._dir(path) is not None:
+                entries, mtime = self._dir(path)
+                mode, nlink, size = stat.S_IFDIR | 0o755, 2, 0
+            else:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+        return os.stat_result((mode, 0, 0, nlink, 0, 0, size, mtime, mtime, mtime))
+
+    def listdir(self, path):
+        with self.lock:
+            entry = self._dir(path)
+            if entry is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+            return list(entry[0])
+
+    def scandir(self, path):
+        with self.lock:
+            entry = self._dir(path)
+            if entry is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+            result = []
+            for name in entry[0]:
+                if path / name in self.files:
+                    content, mtime = self.files[path / name]
+                    result.append((name, False, len(content), mtime))
+                else:
+                    result.append((name, True, 0, self.dirs[path / name][1]))
+            return result
+
+    def open(self, path, mode="rb"):
+        if mode in ("rb", "r"):
+            with self.lock:
+                if path not in self.files:
+                    raise FileNotFoundError(
+                        errno.ENOENT, "No such file or directory", str(path)
+                    )
+                file = io.BytesIO(self.files[path][0])
+        elif mode in ("wb", "w"):
+            self.store(path, b"")  # file exists from now on, like with open()
+            file = self.WriteBuffer(self, path)
+        else:
+            raise ValueError(f"Unsupported mode: {mode}")
+        return file if "b" in mode else io.TextIOWrapper(file, encoding="utf-8")
+
+    def open_upload(self, path, mode="wb", size_hint=None):
+        with self.lock:
+            if self._dir(path.parent) is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+        return self.Upload(self, path, mode)
+
+    def store(self, path, content):
+        with self.lock:
+            parent = self._dir(path.parent)
+            if parent is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+            if path in self.dirs:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory", str(path))
+            self.files[path] = [content, time.time()]
+            parent[0].add(path.name)
+
+    def mkdir(self, path):
+        with self.lock:
+            missing = []
+            while self._dir(path) is None:
+                if path in self.files:
+                    raise FileExistsError(errno.EEXIST, "File exists", str(path))
+                missing.append(path)
+                path = path.parent
+            for path in reversed(missing):
+                self.dirs[path] = [set(), time.time()]
+                self.dirs[path.parent][0].add(path.name)
+
+    def rmdir(self, path):
+        with self.lock:
+            entry = self._dir(path)
+            if entry is None:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+            if entry[0]:
+                raise OSError(errno.ENOTEMPTY, "Directory not empty", str(path))
+            del self.dirs[path]
+            self.dirs[path.parent][0].discard(path.name)
+
+    def unlink(self, path):
+        with self.lock:
+            if path not in self.files:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(path)
+                )
+            del self.files[path]
+            self.dirs[path.parent][0].discard(path.name)
+
+    def rename(self, source, target):
+        with self.lock:
+            target_parent = self._dir(target.parent)
+            if target_parent is None or (
+                source not in self.files and source not in self.dirs
+            ):
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(source)
+                )
+            if source in self.files:
+                if target in self.dirs:
+                    raise IsADirectoryError(errno.EISDIR, "Is a directory", str(target))
+                self.files[target] = self.files.pop(source)
+            else:
+                if target in self.files or (
+                    target in self.dirs and self.dirs[target][0]
+                ):
+                    raise OSError(errno.ENOTEMPTY, "Directory not empty", str(target))
+                if target.parts[: len(source.parts)] == source.parts:
+                    raise OSError(errno.EINVAL, "Invalid argument", str(target))
+                # move the directory and everything below it
+                for table in (self.dirs, self.files):
+                    for path in [
+                        path
+                        for path in table
+                        if path.parts[: len(source.parts)] == source.parts
+                    ]:
+                        table[target / path.relative_to(source)] = table.pop(path)
+            self.dirs[source.parent][0].discard(source.name)
+            target_parent[0].add(target.name)
+
+    def copy(self, source, target):
+        with self.lock:
+            if source not in self.files:
+                raise FileNotFoundError(
+                    errno.ENOENT, "No such file or directory", str(source)
+                )
+            content = self.files[source][0]
+        self.store(target, content)  # bytes are immutable, nothing is copied
+
+
+STORAGES = {"local": LocalStorage, "memory": MemoryStorage}
+
+
+class TreeWalker(threading.Thread):
+    """
+    Walks a directory tree for SITE TREE in the background, depth first.
+
+    Entries are formatted as MLSD-style facts with the path relative to the top directory
+    ("type=file;size=10;modify=20240101120000; dir/file.txt") and handed over in batches
+    through a bounded queue, so memory use doesn't depend on the tree size. None marks the end.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, storage, top, max_depth, max_entries):
+        super().__init__(name="tree-walker", daemon=True)
+        self.storage = storage
+        self.top = top
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.batches = queue.Queue(maxsize=16)
+        self.stopped = threading.Event()  # set by the consumer if it gives up
+        self.entries = 0
+        self.truncated = False
+
+    def run(self):
+        batch = []
+        stack = [(self.top, "", 1)]
+        try:
+            while stack and not self.stopped.is_set():
+                path, relative, depth = stack.pop()
+                try:
+                    # scandir() may be a generator, errors come while iterating
+                    entries = list(self.storage.scandir(path))
+                except OSError:
+                    continue  # removed meanwhile or no access
+                for name, is_dir, size, mtime in entries:
+                    if self.entries >= self.max_entries:
+                        self.truncated = True
+                        return
+                    self.entries += 1
+                    modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+                    if is_dir:
+                        batch.append(f"type=dir;modify={modify}; {relative}{name}\r\n")
+                        if depth < self.max_depth:
+                            stack.append((path / name, f"{relative}{name}/", depth + 1))
+                    else:
+                        batch.append(
+                            f"type=file;size={size};modify={modify}; {relative}{name}\r\n"
+                        )
+                    if len(batch) >= self.BATCH_SIZE:
+                        self._put(batch)
+                        batch = []
+        finally:
+            if batch:
+                self._put(batch)
+            self._put(None)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TransferAborted(Exception):
+    pass
+
+
+# listed by FEAT (RFC 2389), SITE FIND too when the filename index is enabled
+FEATURES = ["MDTM", "MODE B", "SIZE", "SITE CPFR", "SITE CPTO", "SITE TREE", "UTF8"]
+
+BLOCK_HEADER = struct.Struct(
+    ">BH"
+)  # MODE B block: descriptor, byte count (RFC 959 3.4.2)
+BLOCK_EOF = 0x40
+BLOCK_RESTART_MARKER = 0x10
+BLOCK_MAX_SIZE = 0xFFFF
+
+# during a transfer the control connection is polled for ABOR once per this many bytes,
+# well before socket buffers of a client that stopped reading could fill up
+ABORT_CHECK_BYTES = 64 * 1024
+
+TELNET_COMMAND = re.compile(
+    rb"\xff[\xf0-\xfe]?"
+)  # IAC with optional command, e.g. IP, DM
+
+
+class TimerWheel(threading.Thread):
+    """
+    Deadlines of all sessions, checked by one thread instead of a timeout on every socket.
+
+    A session has at most one deadline armed: "login" or "idle" while waiting for a command,
+    "data" while waiting for the client to connect after PASV. When it passes, the socket the
+    session is blocked on is shut down (with a 421 reply on the control connection), which ends
+    the blocked call.
+
+    Sessions are kept in one slot per second of their deadline. Arming again only records the new
+    deadline, a session is moved to its new slot when the old slot comes up, so a command costs a
+    dict update. Every second the due slots are processed and expired sessions closed in bulk.
+    """
+
+    MESSAGES = {
+        "login": b"421 Login timeout, closing connection.\r\n",
+        "idle": b"421 Session timeout, closing connection.\r\n",
+    }
+
+    def __init__(self, slots=512, resolution=1.0):
+        super().__init__(name="timer-wheel", daemon=True)
+        self.slots = [set() for _ in range(slots)]
+        self.resolution = resolution
+        # session -> (deadline, armed at, kind, socket)
+        self.deadlines = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def _slot(self, deadline):
+        return self.slots[int(deadline / self.resolution) % len(self.slots)]
+
+    def arm(self, session, timeout, kind, sock):
+        now = time.monotonic()
+        deadline = now + timeout
+        with self.lock:
+            previous = self.deadlines.get(session)
+            self.deadlines[session] = (deadline, now, kind, sock)
+            if previous is None or deadline < previous[0]:
+                self._slot(deadline).add(session)
+
+    def disarm(self, session):
+        with self.lock:
+            self.deadlines.pop(session, None)
+
+    def retime(self, kind, timeout):
+        """Apply a new timeout to the armed deadlines of the kind, counted from when they were armed"""
+        with self.lock:
+            for session, (deadline, armed, armed_kind, sock) in self.deadlines.items():
+                if armed_kind == kind:
+                    self.deadlines[session] = (armed + timeout, armed, kind, sock)
+                    self._slot(armed + timeout).add(session)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        tick = int(time.monotonic() / self.resolution)
+        while not self.stopped.wait((tick + 1) * self.resolution - time.monotonic()):
+            now = time.monotonic()
+            expired = []
+            with self.lock:
+                # slots of elapsed ticks only hold deadlines that passed or moved later
+                while tick < int(now / self.resolution):
+                    index = tick % len(self.slots)
+                    sessions, self.slots[index] = self.slots[index], set()
+                    for session in sessions:
+                        entry = self.deadlines.get(session)
+                        if entry is None:
+                            continue  # disarmed
+                        if entry[0] <= now:
+                            del self.deadlines[session]
+                            expired.append((session, entry[2], entry[3]))
+                        else:
+                            self._slot(entry[0]).add(session)
+                    tick += 1
+            for session, kind, sock in expired:
+                self.expire(session, kind, sock)
+            if expired:
+                log.debug("Timer wheel expired %d deadlines.", len(expired))
+
+    def expire(self, session, kind, sock):
+        try:
+            if kind in self.MESSAGES:
+                session.log.info("Closing connection, %s timeout.", kind)
+                sock.send(self.MESSAGES[kind], getattr(socket, "MSG_DONTWAIT", 0))
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # closed meanwhile
+
+
+class Profiler(threading.Thread):
+    """
+    Stack sampler for live sessions, to see where commands spend their time.
+
+    A `sample_rate` fraction of commands is picked when dispatched (begin()) and stays picked
+    until the session waits for the next command (end()). Every `interval` seconds the stacks of
+    the threads running picked commands are recorded, counted per command name. Time in C code
+    (bcrypt, socket calls) goes to the Python function that called it. With sample_rate 0 the
+    thread sleeps and a command costs one comparison.
+
+    dump() writes collapsed stacks ("RETR;frame;...;frame samples" per line), the input of
+    flamegraph.pl, inferno or speedscope.
+    """
+
+    def __init__(self, sample_rate, interval, path):
+        super().__init__(name="profiler", daemon=True)
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.path = path
+        self.active = {}  # thread id -> command picked for sampling
+        self.stacks = {}  # (command, code objects from outermost) -> samples
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()  # sample rate changed or stop
+        self.stopped = threading.Event()
+
+    def begin(self, command):
+        if self.sample_rate and random.random() < self.sample_rate:
+            self.active[threading.get_ident()] = command
+
+    def end(self):
+        if self.active:
+            self.active.pop(threading.get_ident(), None)
+
+    def set_sample_rate(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.sample_rate:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            time.sleep(self.interval)
+            if self.active:
+                self.sample()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, command in self.active.copy().items():
+                frame = frames.get(ident)
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = (command, tuple(reversed(codes)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+
+    def dump(self, path=None):
+        """Write the stacks sampled so far to the file, returns samples per command"""
+        with self.lock:
+            stacks = dict(self.stacks)
+        samples = {}
+        lines = []
+        for (command, codes), count in stacks.items():
+            samples[command] = samples.get(command, 0) + count
+            frames = [command] + [
+                f"{getattr(code, 'co_qualname', code.co_name)}"
+                f" ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                for code in codes
+            ]
+            lines.append(";".join(frame.replace(";", ":") for frame in frames))
+            lines[-1] += f" {count}\n"
+        with open(path or self.path, "w", encoding="utf-8") as f:
+            f.writelines(sorted(lines))
+        return samples
+
+
+class FTPSession:
+    """
+    State of one control connection, served by its own thread (start()).
+
+    Most connections sit idle between commands, so a session is kept small: fixed attributes
+    (__slots__), configuration and storage shared with the server, loggers created on use and
+    sockets other than the control connection only while a transfer needs them.
+    """
+
+    __slots__ = (
+        "client_socket",
+        "address",
+        "logged_in",
+        "user",
+        "cwd",
+        "home",
+        "data_socket",
+        "ftp_server",
+        "config",
+        "storage",
+        "transfer_type",
+        "transfer_mode",
+        "rename_from",
+        "copy_from",
+        "allocate_size",
+        "quota_bytes",
+        "quota_files",
+        "thread",
+    )
 
     def __init__(self, client_socket, address, ftp_server):
-        super().__init__()
         self.client_socket = client_socket
         self.address = address
         self.logged_in = False
@@ -66,25 +1583,150 @@ class FTPSession(threading.Thread):
         self.cwd = None
         self.home = None
         self.data_socket = None
-        self.passive_port = None
-        self.passive_socket = None
         self.ftp_server = ftp_server
+        self.config = ftp_server.config
+        self.storage = ftp_server.storage
         self.transfer_type = "I"
+        self.transfer_mode = "S"  # S - stream, B - block (data connection kept open)
+        self.rename_from = None  # source path set by RNFR
+        self.copy_from = None  # source path set by SITE CPFR
+        self.allocate_size = None  # size hint for next STOR set by ALLO
+        self.quota_bytes = None  # limits from users.json, None - no limit
+        self.quota_files = None
+        self.thread = None
+
+    @property
+    def log(self):
+        return SessionLog(log, self)
+
+    @property
+    def trace(self):
+        return SessionLog(trace_log, self)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name=f"session-{self.address[1]}"
+        )
+        self.thread.start()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
 
     def send(self, message):
         self.client_socket.sendall(f"{message}\r\n".encode("utf-8"))
-        print(f"Sent: {message}")
+        self.trace.debug("Sent: %s", message)
 
     def receive(self):
-        data = self.client_socket.recv(1024).decode("utf-8").strip()
-        print(f"Received: {data}")
+        self.ftp_server.profiler.end()  # the command before, if sampled
+        timers = self.ftp_server.timers
+        if self.logged_in:
+            timers.arm(self, self.config.session_timeout, "idle", self.client_socket)
+        else:
+            timers.arm(self, self.config.login_timeout, "login", self.client_socket)
+        try:
+            raw = b""
+            while True:
+                chunk = self.client_socket.recv(1024)
+                raw += chunk
+                if chunk and raw.endswith(b"\xff"):
+                    continue  # Telnet command split, its second byte is on the way
+                # Telnet IP and Synch sent before ABOR (RFC 959) aren't part of the command
+                data = TELNET_COMMAND.sub(b"", raw).decode("utf-8").strip()
+                if data or not chunk:
+                    break
+                raw = b""
+        finally:
+            timers.disarm(self)
+        self.trace.debug("Received: %s", data)
         return data
 
+    def send_data(self, data):
+        """Send part of a transfer over the data connection, as blocks in MODE B"""
+        if self.transfer_mode == "B":
+            with memoryview(data) as view:
+                for offset in range(0, len(view), BLOCK_MAX_SIZE):
+                    block = view[offset : offset + BLOCK_MAX_SIZE]
+                    self.data_socket.sendall(BLOCK_HEADER.pack(0, len(block)) + block)
+        else:
+            self.data_socket.sendall(data)
+
+    def end_data(self):
+        """The transfer was sent completely: EOF block in MODE B, then release_data()"""
+        if self.transfer_mode == "B":
+            self.data_socket.sendall(BLOCK_HEADER.pack(BLOCK_EOF, 0))
+        self.release_data()
+
+    def release_data(self):
+        """Done with the data connection: closed in MODE S, kept open for the next transfer in MODE B"""
+        if self.transfer_mode != "B":
+            self.close_data()
+
+    def close_data(self):
+        if self.data_socket:
+            self.data_socket.close()
+            self.data_socket = None
+
+    def incoming_data(self):
+        """
+        Iterate over the parts of an upload. Ends when the client closes the data connection
+        in MODE S, or with the EOF block in MODE B (closing the connection before is an error).
+        """
+        if self.transfer_mode != "B":
+            while data := self.data_socket.recv(1024):
+                yield data
+            return
+        while True:
+            header = self.data_socket.recv(BLOCK_HEADER.size, socket.MSG_WAITALL)
+            if len(header) < BLOCK_HEADER.size:
+                raise ConnectionError("Data connection closed before EOF block.")
+            descriptor, remaining = BLOCK_HEADER.unpack(header)
+            while remaining:
+                data = self.data_socket.recv(min(remaining, 65536))
+                if not data:
+                    raise ConnectionError("Data connection closed within a block.")
+                remaining -= len(data)
+                if not descriptor & BLOCK_RESTART_MARKER:  # markers aren't file data
+                    yield data
+            if descriptor & BLOCK_EOF:
+                return
+
+    def abort_watcher(self):
+        """
+        Return a function telling, without blocking, whether the client wants the running
+        transfer stopped: ABOR (or Telnet IP) waiting on the control connection, or the control
+        connection closed. Other commands stay queued until the transfer ends.
+        It's called for every chunk with the bytes transferred so far, but looks at the socket
+        only every ABORT_CHECK_BYTES.
+        """
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(self.client_socket, select.POLLIN | select.POLLPRI)
+            readable = lambda: poller.poll(0)
+        else:  # Windows
+            readable = lambda: select.select([self.client_socket], [], [], 0)[0]
+
+        next_check = 0
+
+        def abort_requested(transferred):
+            nonlocal next_check
+            if transferred < next_check:
+                return False
+            next_check = transferred + ABORT_CHECK_BYTES
+            if not readable():
+                return False
+            try:
+                pending = self.client_socket.recv(1024, socket.MSG_PEEK)
+            except OSError:
+                return True
+            return not pending or b"\xff\xf4" in pending or b"ABOR" in pending.upper()
+
+        return abort_requested
+
     def login(self, username, password=None):
-        user = db.get(Query().username == username)
+        user = self.ftp_server.users.get(Query().username == username)
         if user and (
             (  # password for this user is not required and anonymous access is allowed
-                user["password"] is None and ALLOW_ANONYMOUS is True
+                user["password"] is None and self.config.allow_anonymous is True
             )
             or (  # password for this user is required and matches the provided
                 password
@@ -94,13 +1736,32 @@ class FTPSession(threading.Thread):
         ):
             self.logged_in = True
             self.user = username
-            user_home = Path(user["home"]).resolve()
+            self.quota_bytes = user.get("quota_bytes")
+            self.quota_files = user.get("quota_files")
+            user_home = self.storage.resolve(user["home"])
             self.cwd = user_home
             self.home = user_home
-            self.cwd.mkdir(parents=True, exist_ok=True)
+            self.storage.mkdir(self.cwd)
             return True
         return False
 
+    def file_size(self, path):
+        """Size of the file at the path, None if there is no file"""
+        try:
+            stats = self.storage.stat(path)
+        except OSError:
+            return None
+        return None if stat.S_ISDIR(stats.st_mode) else stats.st_size
+
+    def within_quota(self, add_bytes=0, add_files=0):
+        """Check if the user can store add_bytes more bytes in add_files more files"""
+        used_bytes, used_files = self.ftp_server.usage.get(self.user)
+        if self.quota_bytes is not None and used_bytes + add_bytes > self.quota_bytes:
+            return False
+        if self.quota_files is not None and used_files + add_files > self.quota_files:
+            return False
+        return True
+
     def sanitize_path(self, path, check_full_path=True):
         """
         Return the absolute path if it is within the user's home directory.
@@ -114,25 +1775,33 @@ class FTPSession(threading.Thread):
             raise PermissionError("User not logged in.")
 
         if path.startswith("/"):  # client uses absolute path
-            resolved_path = (self.home / path.lstrip("/")).resolve()
+            base, path = self.home, path.lstrip("/")
         else:  # client uses relative path
-            resolved_path = (self.cwd / path).resolve()
+            base = self.cwd
 
-        if not str(resolved_path).startswith(str(self.home)):
-            raise PermissionError("Access outside home directory is forbidden.")
+        cache_key = (self.home, base, path)
+        cached = self.ftp_server.path_cache.get(cache_key)
+        if cached:
+            resolved_path, exists = cached
+            if exists or not check_full_path:
+                return resolved_path
+        else:
+            resolved_path = self.storage.resolve(base / path)
+            # compare components, so that /home/user1 doesn't match /home/user10
+            if resolved_path.parts[: len(self.home.parts)] != self.home.parts:
+                raise PermissionError("Access outside home directory is forbidden.")
 
         if check_full_path:
-            if not resolved_path.exists():
+            if not self.storage.exists(resolved_path):
                 raise PermissionError("File or directory does not exist.")
+            self.ftp_server.path_cache.put(cache_key, resolved_path, True)
         else:
             # Check all parts of the path except the last fragment
             parent_path = resolved_path.parent
-            if not parent_path.exists():
+            if not self.storage.exists(parent_path):
                 raise PermissionError("Parent directory does not exist.")
+            self.ftp_server.path_cache.put(cache_key, resolved_path, False)
 
-        print(
-            f"resolved_path: {resolved_path}\n cwd: {self.cwd}\n path: {path}\n home: {self.home}"
-        )
         return resolved_path
 
     def ftp_path(self, path):
@@ -140,68 +1809,98 @@ class FTPSession(threading.Thread):
         relative_path = path.relative_to(self.home)
         return "/" + str(relative_path).replace("\\", "/")
 
+    def log_transfer(self, path, size, started, direction, completed):
+        """
+        Write a transfer log entry in xferlog format. Only the record is created here,
+        formatting and writing is done by the log writer thread.
+
+        Parameters:
+            direction (str): "o" for RETR (outgoing), "i" for STOR (incoming)
+            completed (bool): False when the transfer was interrupted
+        """
+        if not transfer_log.isEnabledFor(logging.INFO):
+            return
+        transfer_log.info(
+            "%d %s %d %s %s _ %s %s %s ftp 0 * %s",
+            round(time.monotonic() - started),
+            self.address[0],
+            size,
+            str(path).replace(" ", "_"),
+            "b" if self.transfer_type == "I" else "a",
+            direction,
+            "a" if self.user == "anonymous" else "r",
+            self.user,
+            "c" if completed else "i",
+        )
+
     def handle_passive_mode(self):
-        self.passive_port = PASSIVE_PORT_RANGE[0]
+        passive_port = self.config.passive_port_range[0]
         while True:
+            passive_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                self.passive_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.passive_socket.bind(("", self.passive_port))
-                self.passive_socket.listen(1)
+                passive_socket.bind(("", passive_port))
+                passive_socket.listen(1)
                 break
             except OSError:
-                self.passive_port += 1
-                if self.passive_port > PASSIVE_PORT_RANGE[1]:
+                passive_socket.close()
+                passive_port += 1
+                if passive_port > self.config.passive_port_range[1]:
                     self.send("425 Can't open passive connection.")
                     return
         # Inform the client of the passive mode
         ip = self.address[0].replace(".", ",")
-        p1 = self.passive_port // 256
-        p2 = self.passive_port % 256
+        p1 = passive_port // 256
+        p2 = passive_port % 256
         self.send(f"227 Entering Passive Mode ({ip},{p1},{p2}).")
 
+        self.ftp_server.timers.arm(
+            self, self.config.data_timeout, "data", passive_socket
+        )
+        # shutdown() of a listening socket wakes accept() only on Linux, elsewhere the timeout does
+        passive_socket.settimeout(self.config.data_timeout)
         try:
-            self.passive_socket.settimeout(DATA_TIMEOUT)
-            self.data_socket, data_address = self.passive_socket.accept()
+            self.data_socket, data_address = passive_socket.accept()
             # Check if the IP address of the data connection matches the control connection
             if data_address[0] != self.address[0]:
                 self.send("425 Data connection IP mismatch.")
                 self.data_socket.close()
                 self.data_socket = None
                 return
-        except socket.timeout:
-            # Handle the timeout
-            print(
-                f"Timeout: No connection to data socket was made within {DATA_TIMEOUT}. Closing data connection"
+        except OSError:
+            # passive socket shut down by the timer wheel, or its own timeout
+            self.log.warning(
+                "Timeout: No connection to data socket was made within %s. Closing data connection",
+                self.config.data_timeout,
             )
             self.send("425 Data connection timed out.")
-            self.passive_socket.close()  # Close the passive socket
             return
         finally:
+            self.ftp_server.timers.disarm(self)
             # Close the passive socket after accepting the connection
-            self.passive_socket.close()
+            passive_socket.close()
 
     def handle_client(self):
         self.send("220 Welcome to UŚ FTP Server")
-        self.client_socket.settimeout(LOGIN_TIMEOUT)  # Set a timeout for login
+        # urgent data (Telnet Synch before ABOR) is read with the rest of the command
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_OOBINLINE, 1)
         try:
             while not self.logged_in:
                 """login process"""
                 data = self.receive()
                 if not data:
-                    print("closing client socket")
+                    self.log.info("Connection closed before login.")
                     self.client_socket.close()
                     return
                 cmd, *args = data.split()
+                self.ftp_server.profiler.begin(cmd.upper())
                 if cmd.upper() == "USER":
                     self.send("331 Username received, need password.")
                     username = args[0]
                 elif cmd.upper() == "PASS":
                     password = args[0] if args else None
                     if self.login(username, password):
+                        self.log.info("User logged in.")
                         self.send("230 User logged in, proceed.")
-                        self.client_socket.settimeout(
-                            SESSION_TIMEOUT
-                        )  # User logged in, set a timeout for session
                     else:
                         self.send("530 Credentials incorrect.")
                 else:
@@ -215,9 +1914,11 @@ class FTPSession(threading.Thread):
                 if not data:
                     break
                 cmd, *args = data.split()
+                self.ftp_server.profiler.begin(cmd.upper())
 
                 match cmd.upper():
                     case "PASV":
+                        self.close_data()  # e.g. kept open in MODE B
                         self.handle_passive_mode()
 
                     case "LIST":
@@ -225,14 +1926,14 @@ class FTPSession(threading.Thread):
                             self.send("425 Use PASV first.")
                         else:
                             self.send("150 Here comes the directory listing.")
-                            entries = os.listdir(self.cwd)
+                            entries = self.storage.listdir(self.cwd)
                             response = []
                             for entry in entries:
                                 entry_path = self.cwd / entry
-                                stats = entry_path.stat()
+                                stats = self.storage.stat(entry_path)
                                 permissions = (
                                     "drwxr-xr-x"
-                                    if entry_path.is_dir()
+                                    if stat.S_ISDIR(stats.st_mode)
                                     else "-rw-r--r--"
                                 )
                                 n_links = stats.st_nlink
@@ -245,13 +1946,53 @@ class FTPSession(threading.Thread):
                                 response.append(
                                     f"{permissions} {n_links} {owner} {group} {size} {mtime} {entry}"
                                 )
-                            self.data_socket.sendall(
-                                "\r\n".join(response).encode("utf-8")
-                            )
-                            self.data_socket.close()
-                            self.data_socket = None
+                            self.send_data("\r\n".join(response).encode("utf-8"))
+                            self.end_data()
                             self.send("226 Directory send ok.")
 
+                    case "NLST":
+                        if not self.data_socket:
+                            self.send("425 Use PASV first.")
+                            continue
+                        # NLST [directory | [directory/]glob], wildcards only in the last part
+                        pattern = args[0] if args else ""
+                        directory, separator, name_pattern = pattern.rpartition("/")
+                        try:
+                            if any(char in name_pattern for char in "*?["):
+                                path = self.sanitize_path(
+                                    directory or ("/" if separator else ".")
+                                )
+                                prefix = directory + separator
+                            elif pattern:
+                                path = self.sanitize_path(pattern)
+                                prefix = pattern.rstrip("/") + "/"
+                                name_pattern = None
+                                if not self.storage.is_dir(path):  # single file
+                                    path, prefix = None, pattern
+                            else:
+                                path, prefix, name_pattern = self.cwd, "", None
+                        except PermissionError as e:
+                            self.send(f"550 Permission denied. {e}")
+                            self.release_data()
+                            continue
+                        self.send("150 Here comes the file list.")
+                        # names only, no stat per entry; sent in batches
+                        names = self.storage.listdir(path) if path else [""]
+                        batch = []
+                        for name in names:
+                            if name_pattern and not fnmatch.fnmatchcase(
+                                name, name_pattern
+                            ):
+                                continue
+                            batch.append(f"{prefix}{name}\r\n")
+                            if len(batch) == 1000:
+                                self.send_data("".join(batch).encode("utf-8"))
+                                batch = []
+                        if batch:
+                            self.send_data("".join(batch).encode("utf-8"))
+                        self.end_data()
+                        self.send("226 File list send ok.")
+
                     case "PWD":
                         self.send(
                             f'257 "{self.ftp_path(self.cwd)}" is the current directory.'
@@ -287,7 +2028,9 @@ class FTPSession(threading.Thread):
                                 path = self.sanitize_path(
                                     args[0], check_full_path=False
                                 )
-                                path.mkdir(parents=True, exist_ok=True)
+                                self.storage.mkdir(path)
+                                self.ftp_server.path_cache.invalidate(path)
+                                self.ftp_server.names.added(path, is_dir=True)
                                 self.send(f"257 Directory created: {args[0]}.")
                             except PermissionError as e:
                                 self.send(f"550 Permission denied. {e}")
@@ -298,7 +2041,9 @@ class FTPSession(threading.Thread):
                         else:
                             try:
                                 path = self.sanitize_path(args[0])
-                                path.rmdir()
+                                self.storage.rmdir(path)
+                                self.ftp_server.invalidate(path)
+                                self.ftp_server.names.removed(path)
                                 self.send(f"250 Directory deleted: {args[0]}.")
                             except PermissionError as e:
                                 self.send(f"550 Permission denied. {e}")
@@ -312,7 +2057,13 @@ class FTPSession(threading.Thread):
                             self.transfer_type = "A"
                             self.send("200 Type set to A (ASCII).")
                         elif cmd.upper() == "MODE" and args and args[0].upper() == "S":
+                            if self.transfer_mode == "B":
+                                self.close_data()  # no EOF markers to separate transfers any more
+                            self.transfer_mode = "S"
                             self.send("200 Mode set to S (stream).")
+                        elif cmd.upper() == "MODE" and args and args[0].upper() == "B":
+                            self.transfer_mode = "B"
+                            self.send("200 Mode set to B (block).")
                         elif cmd.upper() == "STRU" and args and args[0].upper() == "F":
                             self.send("200 Structure set to F (file).")
                         else:
@@ -329,22 +2080,90 @@ class FTPSession(threading.Thread):
                                 )
                             except PermissionError as e:
                                 self.send(f"550 Permission denied. {e}")
-                                self.data_socket.close()
-                                self.data_socket = None
+                                self.release_data()
                                 continue
-                            self.send("150 Ok to send data.")
                             mode = "wb" if self.transfer_type == "I" else "w"
-                            with open(path, mode) as f:
-                                while True:
-                                    data = self.data_socket.recv(1024)
-                                    if not data:
-                                        break
+                            size_hint, self.allocate_size = self.allocate_size, None
+                            old_size = self.file_size(path)
+                            new_files = 0 if old_size is not None else 1
+                            if not self.within_quota(
+                                (size_hint or 0) - (old_size or 0), new_files
+                            ):
+                                self.send("552 Quota exceeded.")
+                                self.release_data()
+                                continue
+                            try:
+                                upload = self.storage.open_upload(path, mode, size_hint)
+                            except OSError as e:
+                                self.send(f"553 Can't create file. {e.strerror}")
+                                self.release_data()
+                                continue
+                            self.send("150 Ok to send data.")
+                            started, received, completed = time.monotonic(), 0, False
+                            reply = "226 Transfer complete."
+                            abort_requested = self.abort_watcher()
+                            try:
+                                for data in self.incoming_data():
+                                    if abort_requested(received):
+                                        raise TransferAborted()
+                                    received += len(data)
+                                    if (
+                                        self.quota_bytes is not None
+                                        and not self.within_quota(
+                                            received - (old_size or 0), new_files
+                                        )
+                                    ):
+                                        raise QuotaExceeded()
                                     if self.transfer_type == "A":
                                         data = data.decode("utf-8")
-                                    f.write(data)
-                            self.data_socket.close()
-                            self.data_socket = None
-                            self.send("226 Transfer complete.")
+                                    upload.write(data)
+                            except QuotaExceeded:
+                                upload.abort()
+                                reply = "552 Quota exceeded, transfer aborted."
+                            except TransferAborted:
+                                upload.abort()
+                                reply = "426 Transfer aborted."
+                            except OSError:
+                                # connection broken: the old file (if any) stays untouched
+                                upload.abort()
+                                reply = "426 Connection closed; transfer aborted."
+                            except BaseException:
+                                upload.abort()
+                                raise
+                            else:
+                                try:
+                                    # a cached mmap of the old file blocks replacing it on Windows
+                                    self.ftp_server.file_cache.invalidate(path)
+                                    upload.commit()  # readers see the new file from now on
+                                    completed = True
+                                    if new_files:
+                                        self.ftp_server.names.added(path)
+                                    self.ftp_server.usage.update(
+                                        self.user,
+                                        self.file_size(path) - (old_size or 0),
+                                        new_files,
+                                    )
+                                except OSError as e:
+                                    reply = (
+                                        f"451 Requested action aborted. {e.strerror}"
+                                    )
+                            finally:
+                                self.log_transfer(
+                                    path, received, started, "i", completed
+                                )
+                            self.ftp_server.file_cache.invalidate(path)
+                            if completed:
+                                self.release_data()
+                            else:
+                                self.close_data()
+                            self.send(reply)
+
+                    case "ALLO":
+                        try:
+                            self.allocate_size = int(args[0])
+                            self.send("200 ALLO command successful.")
+                        except (IndexError, ValueError):
+                            self.send("501 Syntax error in parameters.")
 
                     case "RETR":
                         if not self.data_socket:
@@ -353,24 +2172,57 @@ class FTPSession(threading.Thread):
                             filename = args[0]
                             try:
                                 path = self.sanitize_path(filename)
+                                if not self.storage.is_file(path):
+                                    raise PermissionError("Not a file.")
                             except PermissionError as e:
                                 self.send(f"550 Permission denied. {e}")
-                                self.data_socket.close()
-                                self.data_socket = None
+                                self.release_data()
                                 continue
                             self.send("150 Will send data.")
                             mode = "rb" if self.transfer_type == "I" else "r"
-                            with open(path, mode) as f:
-                                while True:
-                                    data = f.read(1024)
-                                    if not data:
-                                        break
-                                    if self.transfer_type == "A":
-                                        data = data.encode("utf-8")
-                                    self.data_socket.sendall(data)
-                            self.data_socket.close()
-                            self.data_socket = None
-                            self.send("226 Transfer complete.")
+                            started, sent, completed = time.monotonic(), 0, False
+                            reply = "226 Transfer complete."
+                            abort_requested = self.abort_watcher()
+                            try:
+                                cached = (
+                                    self.ftp_server.file_cache.get(path)
+                                    if self.transfer_type == "I"
+                                    else None
+                                )
+                                if cached is not None:
+                                    with memoryview(cached) as view:
+                                        for offset in range(0, len(view), 1024 * 1024):
+                                            if abort_requested(sent):
+                                                raise TransferAborted()
+                                            chunk = view[offset : offset + 1024 * 1024]
+                                            self.send_data(chunk)
+                                            sent += len(chunk)
+                                else:
+                                    with self.storage.open(path, mode) as f:
+                                        while True:
+                                            data = f.read(1024)
+                                            if not data:
+                                                break
+                                            if abort_requested(sent):
+                                                raise TransferAborted()
+                                            if self.transfer_type == "A":
+                                                data = data.encode("utf-8")
+                                            self.send_data(data)
+                                            sent += len(data)
+                                completed = True
+                            except TransferAborted:
+                                reply = "426 Transfer aborted."
+                            except (ConnectionError, socket.timeout):
+                                reply = "426 Connection closed; transfer aborted."
+                            except OSError as e:  # e.g. removed or unreadable meanwhile
+                                reply = f"451 Read failed. {e.strerror}"
+                            finally:
+                                self.log_transfer(path, sent, started, "o", completed)
+                            if completed:
+                                self.end_data()
+                            else:
+                                self.close_data()
+                            self.send(reply)
 
                     case "DELE":
                         if not args:
@@ -378,11 +2230,290 @@ class FTPSession(threading.Thread):
                         else:
                             try:
                                 path = self.sanitize_path(args[0])
-                                path.unlink()
+                                size = self.file_size(path)
+                                # a cached mmap would keep the file from being deleted on Windows
+                                self.ftp_server.file_cache.invalidate(path)
+                                self.storage.unlink(path)
+                                self.ftp_server.invalidate(path)
+                                self.ftp_server.names.removed(path)
+                                if size is not None:
+                                    self.ftp_server.usage.update(self.user, -size, -1)
                                 self.send(f"250 File deleted: {args[0]}.")
                             except PermissionError as e:
                                 self.send(f"550 Permission denied. {e}")
 
+                    case "RNFR":
+                        if not args:
+                            self.send("501 No file specified.")
+                        else:
+                            try:
+                                self.rename_from = self.sanitize_path(args[0])
+                                self.send("350 Ready for RNTO.")
+                            except PermissionError as e:
+                                self.send(f"550 Permission denied. {e}")
+
+                    case "RNTO":
+                        if not self.rename_from:
+                            self.send("503 Bad sequence of commands. Use RNFR first.")
+                        elif not args:
+                            self.send("501 No file specified.")
+                        else:
+                            source, self.rename_from = self.rename_from, None
+                            try:
+                                path = self.sanitize_path(
+                                    args[0], check_full_path=False
+                                )
+                                if path == self.home:
+                                    raise PermissionError("Target is home directory.")
+                                replaced_size = (
+                                    self.file_size(path)
+                                    if path != source and self.storage.is_file(source)
+                                    else None
+                                )
+                                # mmaps of cached files block renaming on Windows
+                                self.ftp_server.file_cache.invalidate(source)
+                                self.ftp_server.file_cache.invalidate(path)
+                                self.storage.rename(source, path)
+                                if replaced_size is not None:
+                                    # a file was overwritten
+                                    self.ftp_server.usage.update(
+                                        self.user, -replaced_size, -1
+                                    )
+                                self.ftp_server.invalidate(source)
+                                self.ftp_server.invalidate(path)
+                                self.ftp_server.names.renamed(source, path)
+                                self.send(f"250 Rename successful: {args[0]}.")
+                            except PermissionError as e:
+                                self.send(f"550 Permission denied. {e}")
+                            except OSError as e:
+                                self.send(f"550 Rename failed. {e.strerror}")
+
+                    case "SITE":
+                        subcmd = args[0].upper() if args else ""
+                        if subcmd == "CPFR":
+                            if len(args) < 2:
+                                self.send("501 No file specified.")
+                                continue
+                            try:
+                                path = self.sanitize_path(args[1])
+                                if not self.storage.is_file(path):
+                                    raise PermissionError("Only files can be copied.")
+                                self.copy_from = path
+                                self.send("350 Ready for SITE CPTO.")
+                            except PermissionError as e:
+                                self.send(f"550 Permission denied. {e}")
+                        elif subcmd == "CPTO":
+                            if not self.copy_from:
+                                self.send(
+                                    "503 Bad sequence of commands. Use SITE CPFR first."
+                                )
+                                continue
+                            if len(args) < 2:
+                                self.send("501 No file specified.")
+                                continue
+                            source, self.copy_from = self.copy_from, None
+                            try:
+                                path = self.sanitize_path(
+                                    args[1], check_full_path=False
+                                )
+                                if self.storage.is_dir(path):
+                                    path = path / source.name
+                                if path == source:
+                                    raise PermissionError(
+                                        "Source and target are the same file."
+                                    )
+                                size = self.file_size(source)
+                                replaced_size = self.file_size(path)
+                                new_files = 0 if replaced_size is not None else 1
+                                if not self.within_quota(
+                                    size - (replaced_size or 0), new_files
+                                ):
+                                    self.send("552 Quota exceeded.")
+                                    continue
+                                self.ftp_server.file_cache.invalidate(path)
+                                self.storage.copy(source, path)
+                                self.ftp_server.usage.update(
+                                    self.user, size - (replaced_size or 0), new_files
+                                )
+                                self.ftp_server.file_cache.invalidate(path)
+                                self.ftp_server.names.added(path)
+                                self.send(f"250 Copy successful: {args[1]}.")
+                            except PermissionError as e:
+                                self.send(f"550 Permission denied. {e}")
+                            except OSError as e:
+                                self.send(f"550 Copy failed. {e.strerror}")
+                        elif subcmd == "TREE":
+                            # SITE TREE [path [max depth]]
+                            if not self.data_socket:
+                                self.send("425 Use PASV first.")
+                                continue
+                            try:
+                                path = self.sanitize_path(
+                                    args[1] if len(args) > 1 else "."
+                                )
+                                max_depth = min(
+                                    int(args[2]) if len(args) > 2 else 1 << 30,
+                                    self.config.tree_max_depth,
+                                )
+                                if not self.storage.is_dir(path):
+                                    raise PermissionError("Not a directory.")
+                            except (PermissionError, ValueError) as e:
+                                self.send(f"550 Permission denied. {e}")
+                                self.release_data()
+                                continue
+                            self.send("150 Here comes the directory tree.")
+                            walker = TreeWalker(
+                                self.storage,
+                                path,
+                                max_depth,
+                                self.config.tree_max_entries,
+                            )
+                            walker.start()
+                            try:
+                                while (batch := walker.batches.get()) is not None:
+                                    self.send_data("".join(batch).encode("utf-8"))
+                            except OSError:
+                                self.close_data()
+                                self.send("426 Connection closed; transfer aborted.")
+                                continue
+                            finally:
+                                walker.stopped.set()
+                            self.end_data()
+                            if walker.truncated:
+                                self.send(
+                                    f"226 Tree send ok, truncated after {walker.entries} entries."
+                                )
+                            else:
+                                self.send(
+                                    f"226 Tree send ok, {walker.entries} entries."
+                                )
+                        elif subcmd == "FIND":
+                            # SITE FIND <glob|substring>, matches names anywhere in the home
+                            names = self.ftp_server.names.get(self.home)
+                            if names is None:
+                                self.send("502 Filename index is disabled.")
+                                continue
+                            if len(args) < 2:
+                                self.send("501 No pattern specified.")
+                                continue
+                            if not self.data_socket:
+                                self.send("425 Use PASV first.")
+                                continue
+                            if not names.ready:
+                                self.send(
+                                    "450 Filename index is being built, try again later."
+                                )
+                                self.release_data()
+                                continue
+                            pattern = " ".join(args[1:])
+                            if not any(char in pattern for char in "*?["):
+                                pattern = f"*{pattern}*"  # substring
+                            paths = names.find(pattern, self.config.find_max_results)
+                            self.send("150 Here comes the list of matches.")
+                            for i in range(0, len(paths), 1000):
+                                self.send_data(
+                                    "".join(
+                                        f"/{path}\r\n" for path in paths[i : i + 1000]
+                                    ).encode("utf-8")
+                                )
+                            self.end_data()
+                            self.send(f"226 Found {len(paths)} matches.")
+                        elif subcmd == "PROFILE":
+                            # SITE PROFILE [DUMP | RESET | RATE <fraction>], AdminUsers only
+                            if self.user not in self.config.admin_users:
+                                self.send("550 Permission denied. Administrators only.")
+                                continue
+                            profiler = self.ftp_server.profiler
+                            action = args[1].upper() if len(args) > 1 else "DUMP"
+                            if action == "RATE":
+                                try:
+                                    sample_rate = float(args[2])
+                                    if not 0 <= sample_rate <= 1:
+                                        raise ValueError(sample_rate)
+                                except (IndexError, ValueError):
+                                    self.send("501 Sample rate must be 0-1.")
+                                    continue
+                                profiler.set_sample_rate(sample_rate)
+                                self.log.info(
+                                    "Profile sample rate set to %s.", sample_rate
+                                )
+                                self.send(
+                                    f"200 Sampling {sample_rate:.1%} of commands."
+                                )
+                            elif action == "RESET":
+                                profiler.reset()
+                                self.send("200 Profile cleared.")
+                            elif action == "DUMP":
+                                try:
+                                    samples = profiler.dump()
+                                except OSError as e:
+                                    self.send(f"550 Can't write profile. {e.strerror}")
+                                    continue
+                                self.send(
+                                    f"200 Profile written to {profiler.path}:"
+                                    + "".join(
+                                        f" {command}={count}"
+                                        for command, count in sorted(samples.items())
+                                    )
+                                )
+                            else:
+                                self.send("501 Use SITE PROFILE DUMP, RESET or RATE.")
+                        elif subcmd == "CACHE":
+                            stats = self.ftp_server.file_cache.stats()
+                            self.send(
+                                "211 File cache: "
+                                + " ".join(f"{k}={v}" for k, v in stats.items())
+                            )
+                        else:
+                            self.send("504 SITE command not implemented.")
+
+                    case "ABOR":
+                        # a running transfer was already stopped and answered with 426
+                        self.close_data()
+                        self.send("226 Abort successful.")
+
+                    case "FEAT":
+                        features = FEATURES
+                        if self.ftp_server.names.enabled:
+                            features = sorted(features + ["SITE FIND"])
+                        self.send(
+                            "211-Extensions supported:\r\n"
+                            + "".join(f" {feature}\r\n" for feature in features)
+                            + "211 End"
+                        )
+
+                    case "OPTS":
+                        option = " ".join(args).upper()
+                        if option in ("UTF8 ON", "UTF-8 ON"):
+                            self.send("200 UTF8 is always on.")
+                        else:
+                            self.send("501 Option not understood.")
+
+                    case "SIZE" | "MDTM":
+                        if not args:
+                            self.send("501 No file specified.")
+                            continue
+                        try:
+                            path = self.sanitize_path(" ".join(args))
+                            if not self.storage.is_file(path):
+                                raise PermissionError("Not a file.")
+                            stats = self.storage.stat(path)
+                        except PermissionError as e:
+                            self.send(f"550 Permission denied. {e}")
+                            continue
+                        except OSError as e:
+                            self.send(f"550 File unavailable. {e.strerror}")
+                            continue
+                        if cmd.upper() == "SIZE":
+                            self.send(f"213 {stats.st_size}")
+                        else:  # modification time in UTC (RFC 3659)
+                            self.send(
+                                "213 "
+                                + time.strftime(
+                                    "%Y%m%d%H%M%S", time.gmtime(stats.st_mtime)
+                                )
+                            )
+
                     case "NOP" | "NOOP":
                         # No Operation
                         self.send("200 Command okay.")
@@ -394,76 +2525,242 @@ class FTPSession(threading.Thread):
 
                     case _:
                         self.send("502 Command not implemented.")
-        except socket.timeout:
-            self.send("421 Session timeout, closing connection.")
-            self.client_socket.close()
-        except ConnectionResetError:
-            print("Connection reset by peer.")
+        except ConnectionError:
+            self.log.info("Connection reset by peer.")
             self.client_socket.close()
         except Exception as e:
             if self.client_socket.fileno() != -1:
                 self.send(f"500 Internal server error")
-            print(f"Error: {e}")
+            self.log.error("Error: %s", e)
             self.client_socket.close()
 
     def run(self):
-        self.handle_client()
+        try:
+            self.handle_client()
+        finally:
+            self.ftp_server.profiler.end()
         return self.ftp_server.remove_session(self)
 
 
 class FTPServer:
-    def __init__(self, host="0.0.0.0", port=FTP_PORT):
+    """
+    FTP server built from a ServerConfig. Construction is cheap: the listening socket is created
+    by bind() (or start()) and the user database is opened on first login.
+    Files are served from `storage` (a Storage instance), by default the one named in config.
+    """
+
+    def __init__(self, config, storage=None):
+        self.config = config
+        self.storage = storage or STORAGES[config.storage].from_config(config)
+        self.server_socket = None
+        self.sessions = []
+        self.path_cache = PathCache(config.path_cache_size)
+        self.usage = UsageIndex(
+            self.storage, config.usage_index_file, config.scan_workers
+        )
+        self.file_cache = FileCache(
+            self.storage, config.file_cache_size, config.file_cache_mmap_threshold
+        )
+        self.names = NameIndex(self.storage, config.filename_index, config.scan_workers)
+        self.timers = TimerWheel()
+        self.profiler = Profiler(
+            config.profile_sample_rate,
+            config.profile_interval / 1000,
+            config.profile_file,
+        )
+        self._users = None
+        self._users_lock = threading.Lock()
+        self.running = False
+
+    @classmethod
+    def from_config_file(cls, config_file="ftpserver.conf"):
+        return cls(ServerConfig.from_file(config_file))
+
+    @property
+    def users(self):
+        """User database, opened (and anonymous user added) on first use"""
+        if self._users is None:
+            with self._users_lock:
+                if self._users is None:
+                    users = TinyDB(self.config.users_file)
+                    # Preload Default Users
+                    if not users.contains(Query().username == "anonymous"):
+                        users.insert(
+                            {
+                                "username": "anonymous",
+                                "password": None,
+                                "home": str(self.config.root_dir / "anonymous"),
+                            }
+                        )
+                    self._users = users
+        return self._users
+
+    @property
+    def port(self):
+        """Port the server listens on, useful when configured with port 0"""
+        return self.server_socket.getsockname()[1] if self.server_socket else None
+
+    def bind(self):
+        """Create the listening socket. Raises OSError if the address can't be used."""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.bind((host, port))
+            self.server_socket.bind((self.config.host, self.config.port))
             self.server_socket.listen(5)
-            self.sessions = []
-        except OSError as e:
-            if e.errno == 10048:
-                print(
-                    f"Error: Port {FTP_PORT} for ip {FTP_IP} is in use. Change target port in configuration file {CONFIG_FILE}."
-                )
-            else:
-                print(f"Unexpected error: {e}")
-            sys.exit(1)
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            sys.exit(1)
+        except OSError:
+            self.server_socket.close()
+            self.server_socket = None
+            raise
+        return self.port
+
+    def invalidate(self, path):
+        """Forget cached information about the path and everything below it, after it was removed or renamed"""
+        self.path_cache.invalidate(path)
+        self.file_cache.invalidate(path)
 
     def remove_session(self, session):
         """Remove the session from the sessions list"""
         if session in self.sessions:
             self.sessions.remove(session)
-            print(f"Session removed. Active sessions: {len(self.sessions)}")
+            log.info("Session removed. Active sessions: %d", len(self.sessions))
+
+    def set_timeouts(self, session_timeout=None, login_timeout=None):
+        """Change timeouts at runtime, sessions already waiting get the new ones too"""
+        if session_timeout is not None:
+            self.config.session_timeout = session_timeout
+            self.timers.retime("idle", session_timeout)
+        if login_timeout is not None:
+            self.config.login_timeout = login_timeout
+            self.timers.retime("login", login_timeout)
+        log.info(
+            "Timeouts set: session %ss, login %ss.",
+            self.config.session_timeout,
+            self.config.login_timeout,
+        )
+
+    def stop(self):
+        """Stop accepting connections, start() returns after active sessions end"""
+        self.running = False
+        if self.server_socket:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+            except OSError:
+                pass
 
     def start(self):
-        print(f"FTP Server running on port {FTP_PORT}")
+        if not self.server_socket:
+            self.bind()
+        if self.config.thread_stack_size:
+            # process-wide, applies to the threads started from now on (sessions and workers)
+            threading.stack_size(self.config.thread_stack_size)
+        homes = [
+            (user["username"], self.storage.resolve(user["home"]))
+            for user in self.users.all()
+        ]
+        self.usage.load_or_rebuild(homes)
+        self.names.build(home for _, home in homes)
+        self.running = True
+        self.timers.start()
+        self.profiler.start()
+        log.info("FTP Server running on port %s", self.port)
         try:
-            self.server_socket.settimeout(
-                1.0
-            )  # Set a timeout to allow checking for interrupt
-            while True:
-                print(
-                    f"Awaiting new connections. {len(self.sessions)} active connections"
-                )
+            if not sys.platform.startswith("linux"):
+                # a blocking accept() can't be interrupted with Ctrl+C on Windows,
+                # and stop()'s shutdown() of a listening socket only wakes it on Linux
+                self.server_socket.settimeout(1.0)
+            while self.running:
                 try:
                     client_socket, address = self.server_socket.accept()
                 except socket.timeout:
                     continue  # Allows the loop to periodically check for KeyboardInterrupt
-                print("Wild connection appeared!")
+                except OSError as e:
+                    if not self.running:
+                        break  # stop() shut the socket down
+                    if e.errno not in (errno.EMFILE, errno.ENFILE):
+                        raise
+                    # out of file descriptors, wait for sessions to end instead of exiting
+                    log.warning("Can't accept connection: %s", e.strerror)
+                    time.sleep(0.1)
+                    continue
+                log.info(
+                    "New connection from %s. %d active connections",
+                    address[0],
+                    len(self.sessions) + 1,
+                )
                 session = FTPSession(client_socket, address, ftp_server=self)
                 session.start()
                 self.sessions.append(session)
         except KeyboardInterrupt:
-            print("Shutting down FTP server.")
-            if len(self.sessions) > 0:
-                print("Waiting for active sessions to close...")
-                for session in self.sessions:
-                    session.join()
-            self.server_socket.close()
-            print("Goodbye!")
+            log.info("Shutting down FTP server.")
+        if len(self.sessions) > 0:
+            log.info("Waiting for active sessions to close...")
+            for session in list(self.sessions):
+                session.join()
+        self.server_socket.close()
+        self.server_socket = None
+        self.timers.stop()
+        self.profiler.stop()
+        self.names.close()
+        self.usage.save()
+        log.info("Goodbye!")
 
 
-if __name__ == "__main__":
-    server = FTPServer(host=FTP_IP)
+def main(config_file="ftpserver.conf"):
+    try:
+        config = ServerConfig.from_file(config_file)
+    except KeyError as e:
+        print(f"Error: Missing section or option in configuration file: {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: Invalid value in configuration file: {e}")
+        sys.exit(1)
+    except FileNotFoundError as e:
+        print(f"Error: Configuration file not found: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        sys.exit(1)
+
+    setup_logging(config)
+    server = FTPServer(config)
+
+    def reload_timeouts(signum, frame):
+        try:
+            reloaded = ServerConfig.from_file(config_file)
+        except Exception as e:
+            log.error("Can't reload configuration file: %s", e)
+            return
+        server.set_timeouts(reloaded.session_timeout, reloaded.login_timeout)
+
+    if hasattr(
+        signal, "SIGHUP"
+    ):  # SessionTimeout and LoginTimeout are reloaded on SIGHUP
+        signal.signal(signal.SIGHUP, reload_timeouts)
+
+    def dump_profile(signum, frame):
+        try:
+            samples = server.profiler.dump()
+        except OSError as e:
+            log.error("Can't write profile: %s", e)
+            return
+        log.info("Profile written to %s: %s", config.profile_file, samples)
+
+    if hasattr(signal, "SIGUSR1"):  # sampled stacks are written on SIGUSR1
+        signal.signal(signal.SIGUSR1, dump_profile)
+    try:
+        server.bind()
+    except OSError as e:
+        if e.errno in (errno.EADDRINUSE, 10048):  # 10048 is WSAEADDRINUSE
+            log.error(
+                "Error: Port %s for ip %s is in use. Change target port in configuration file %s.",
+                config.port,
+                config.host,
+                config_file,
+            )
+        else:
+            log.error("Unexpected error: %s", e)
+        sys.exit(1)
     server.start()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "ftpserver.conf")
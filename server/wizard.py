@@ -1,7 +1,18 @@
 import bcrypt
 from pathlib import Path
 from tinydb import TinyDB, Query
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+import argparse
+import concurrent.futures
 import configparser
+import csv
+import json
+import os
+import sys
+import time
+
+BCRYPT_ROUNDS = 12  # cost factor, bcrypt's default; each +1 doubles the time of a login
 
 
 def add_user():
@@ -17,6 +28,12 @@ def add_user():
         print("Both username and password are required!")
         return
 
+    quota_bytes = input("Quota in bytes (empty for no limit): ").strip()
+    quota_files = input("Quota in number of files (empty for no limit): ").strip()
+    if not all(quota.isdigit() for quota in (quota_bytes, quota_files) if quota):
+        print("Quota must be a number!")
+        return
+
     if not db.contains(User.username == username):
         hashed_password = bcrypt.hashpw(
             password.encode("utf-8"), bcrypt.gensalt()
@@ -28,6 +45,8 @@ def add_user():
                 "username": username,
                 "password": hashed_password,
                 "home": home_dir,
+                "quota_bytes": int(quota_bytes) if quota_bytes else None,
+                "quota_files": int(quota_files) if quota_files else None,
             }
         )
         print(f"User '{username}' added successfully!")
@@ -35,6 +54,155 @@ def add_user():
         print(f"User '{username}' already exists.")
 
 
+def hash_password(job):
+    """
+    Runs in a worker process: (password, rounds, current hash or None) -> new hash,
+    or None if the current hash already matches the password.
+    """
+    password, rounds, current = job
+    password = password.encode("utf-8")
+    if current and bcrypt.checkpw(password, current.encode()):
+        return None
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode()
+
+
+def read_users(path, file_format=None):
+    """Yields (line number, record) from a CSV file with a header row or a JSONL file"""
+    file_format = file_format or (
+        "jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv"
+    )
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "csv":
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield number, json.loads(line)
+
+
+def import_users(
+    path,
+    users_file="users.json",
+    rounds=BCRYPT_ROUNDS,
+    upsert=False,
+    workers=None,
+    file_format=None,
+):
+    """
+    Add users from a CSV (header username,password[,home,quota_bytes,quota_files]) or JSONL file
+    (objects with the same keys), without any prompt. Passwords are hashed on a process pool and
+    the users file is written once, at the end. Existing users are skipped, or updated with upsert:
+    only the fields present in the file change, the password is rehashed only if it changed.
+    """
+    started = time.perf_counter()
+    records = {}  # username -> (password, fields given in the file)
+    for number, record in read_users(path, file_format):
+        username = str(record.get("username") or "").strip()
+        password = str(record.get("password") or "").strip()
+        quota_bytes, quota_files = (
+            "" if record.get(key) is None else str(record[key]).strip()
+            for key in ("quota_bytes", "quota_files")
+        )
+        if not username or not password:
+            print(f"{path}:{number}: username and password are required, skipped.")
+            continue
+        if not all(quota.isdigit() for quota in (quota_bytes, quota_files) if quota):
+            print(f"{path}:{number}: quota must be a number, skipped.")
+            continue
+        if username in records:
+            print(f"{path}:{number}: user '{username}' repeated, the last one is used.")
+        # only the fields present in the file, an upsert leaves the others as they are
+        fields = {}
+        if record.get("home"):
+            fields["home"] = record["home"]
+        for key, quota in (("quota_bytes", quota_bytes), ("quota_files", quota_files)):
+            if key in record:  # empty - no limit
+                fields[key] = int(quota) if quota else None
+        records[username] = (password, fields)
+
+    # all changes stay in the cache until close(), a single write of the file
+    with TinyDB(users_file, storage=CachingMiddleware(JSONStorage)) as db:
+        existing = {user["username"]: user for user in db.all()}
+        skipped = 0
+        if not upsert:
+            for username in records.keys() & existing.keys():
+                del records[username]
+                skipped += 1
+
+        usernames = list(records)
+        jobs = [
+            (
+                records[username][0],
+                rounds,
+                existing[username]["password"] if username in existing else None,
+            )
+            for username in usernames
+        ]
+        hashes = []
+        if jobs:
+            workers = workers or os.cpu_count()
+            hashing = reported = time.perf_counter()
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                results = executor.map(
+                    hash_password,
+                    jobs,
+                    chunksize=max(1, min(64, len(jobs) // (workers * 4))),
+                )
+                for done, hashed in enumerate(results, 1):
+                    hashes.append(hashed)
+                    now = time.perf_counter()
+                    if now - reported >= 1 or done == len(jobs):
+                        reported = now
+                        print(
+                            f"\rHashed {done}/{len(jobs)} passwords"
+                            f" ({done / (now - hashing):.0f}/s)",
+                            end="",
+                            flush=True,
+                        )
+            print()
+
+        added, updates = [], {}
+        for username, hashed in zip(usernames, hashes):
+            user = records[username][1]
+            if username not in existing:
+                added.append(
+                    {
+                        "username": username,
+                        "password": hashed,
+                        "home": str(Path("./ftp") / username),
+                        "quota_bytes": None,
+                        "quota_files": None,
+                        **user,
+                    }
+                )
+                continue
+            if hashed:
+                user["password"] = hashed
+            changes = {
+                key: value
+                for key, value in user.items()
+                if existing[username].get(key) != value
+            }
+            if changes:
+                updates[username] = changes
+        if added:
+            db.insert_multiple(added)
+        if updates:
+            db.update(
+                lambda user: user.update(updates[user["username"]]),
+                doc_ids=[existing[username].doc_id for username in updates],
+            )
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{len(added)} users added, {len(updates)} updated,"
+        f" {len(usernames) - len(added) - len(updates)} unchanged, {skipped} already existing skipped"
+        f" in {elapsed:.1f} s ({len(usernames) / elapsed:.0f} users/s)."
+    )
+
+
 def create_config():
     """create the config file"""
     config = configparser.ConfigParser()
@@ -84,8 +252,9 @@ def main():
     while True:
         print("\n-- Menu --")
         print("1. Add User")
-        print("2. Create Config File")
-        print("3. Exit")
+        print("2. Import Users (CSV/JSONL)")
+        print("3. Create Config File")
+        print("4. Exit")
 
         choice = input("Choose an option: ").strip()
 
@@ -93,13 +262,55 @@ def main():
             case "1":
                 add_user()
             case "2":
-                create_config()
+                path = input("File to import: ").strip()
+                if not os.path.isfile(path):
+                    print(f"File '{path}' not found.")
+                    continue
+                upsert = input("Update existing users? (y/N): ").strip().lower()
+                import_users(path, upsert=upsert == "y")
             case "3":
+                create_config()
+            case "4":
                 print("Exiting...")
                 break
             case _:
                 print("Invalid choice, please try again.")
 
 
+def parse_args():
+    """Non-interactive use: wizard.py import users.csv [--upsert] [--rounds 12] ..."""
+    parser = argparse.ArgumentParser(description="FTP server setup.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bulk = commands.add_parser("import", help="add users from a CSV or JSONL file")
+    bulk.add_argument("file")
+    bulk.add_argument("--users-file", default="users.json")
+    bulk.add_argument(
+        "--format", choices=["csv", "jsonl"], help="default: by extension"
+    )
+    bulk.add_argument(
+        "--rounds", type=int, default=BCRYPT_ROUNDS, help="bcrypt cost factor (4-31)"
+    )
+    bulk.add_argument(
+        "--workers", type=int, help="hashing processes, default: number of CPUs"
+    )
+    bulk.add_argument(
+        "--upsert",
+        action="store_true",
+        help="update existing users, passwords rehashed only if changed",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        args = parse_args()
+        import_users(
+            args.file,
+            args.users_file,
+            args.rounds,
+            args.upsert,
+            args.workers,
+            args.format,
+        )
+    else:
+        main()